@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+# Write-through cache of the open alert ids per stream, for the daemon (Alert_Cache_Refresh).
+# With the ids in memory a cycle only loads the problems that are new to the stream into
+# zabbix_rows and deletes the cleared ones by id, instead of shipping the whole open set and
+# anti-joining the alert table. Every writer (reconcilers, webhook.py, the bootstrap) bumps the
+# stream's row in alertversions in its own transaction. The cache is checked against it when a
+# cycle opens the stream, and a commit only writes its own changes back when its bump directly
+# follows that version; otherwise another node or the webhook wrote in between and the entry is
+# dropped, to be reloaded next cycle. The ids are reloaded in any case after refreshAfter seconds.
+import time
+import threading
+from database import execute
+
+## Queries - ALERT VERSIONS
+versionSelect = "SELECT version FROM alertversions WHERE stream = %s;"
+versionBump = """INSERT INTO alertversions (stream, version) VALUES (%s, 1)
+    ON CONFLICT (stream) DO UPDATE SET version = alertversions.version + 1
+    RETURNING version;"""
+
+# Called in the transaction that inserted or deleted alert rows; returns the new version
+def bumpVersion(cur, streamName):
+    execute(cur, "alert_version_bump", versionBump, (streamName,))
+    return cur.fetchone()[0]
+
+
+class AlertCache:
+    def __init__(self, refreshAfter=3600):
+        self.refreshAfter = refreshAfter
+        self.streams = {} # stream name -> [version, ids, loaded at]
+        self.lock = threading.Lock()
+        self.stats = {"hits": 0, "loads": 0}
+
+    # (version, the stream's open ids), reloaded inside the caller's transaction when stale
+    def known(self, cur, stream):
+        execute(cur, "alert_version", versionSelect, (stream.name,))
+        row = cur.fetchone()
+        version = row[0] if row else 0
+        with self.lock:
+            entry = self.streams.get(stream.name)
+            if entry and entry[0] == version and time.monotonic() - entry[2] < self.refreshAfter:
+                self.stats["hits"] += 1
+                return version, entry[1]
+
+        execute(cur, f"alert_ids_{stream.name}", f"SELECT eventid FROM {stream.table};")
+        ids = {eventid for eventid, in cur.fetchall()}
+        with self.lock:
+            self.streams[stream.name] = [version, ids, time.monotonic()]
+            self.stats["loads"] += 1
+        return version, ids
+
+    # After the caller's commit: its own changes and the version they were committed under
+    def apply(self, streamName, version, added, removed):
+        with self.lock:
+            entry = self.streams.get(streamName)
+            if entry is None:
+                return
+            entry[0] = version
+            entry[1].update(added)
+            entry[1].difference_update(removed)
+
+    # Cached open alerts of a stream, None when not loaded
+    def size(self, streamName):
+        with self.lock:
+            entry = self.streams.get(streamName)
+            return len(entry[1]) if entry else None
+
+    def invalidate(self, streamName=None):
+        with self.lock:
+            if streamName is None:
+                self.streams.clear()
+            else:
+                self.streams.pop(streamName, None)
+
+    def summary(self):
+        with self.lock:
+            stats = dict(self.stats)
+            size = sum(len(entry[1]) for entry in self.streams.values())
+            for key in self.stats:
+                self.stats[key] = 0
+        return f"Alert cache: {size} open ids, {stats['hits']} hits, {stats['loads']} loads"
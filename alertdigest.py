@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+# Alert storm aggregation used by newchecks.py.
+# Messages produced by the reconcilers are held per room until the end of the
+# cycle. Rooms that got more than the threshold receive one markdown digest
+# instead of one message per alert; quiet rooms get their messages unchanged.
+import threading
+from collections import defaultdict
+
+digestTitle = "**Alert storm: {} new, {} resolved** ({})"
+digestSection = "\n\n**{}** ({}):\n{}"
+digestLine = "- {} - {}"
+digestMore = "- ... and {} more"
+
+
+class AlertDigester:
+    def __init__(self, threshold=10, maxHosts=20):
+        self.threshold = threshold # messages per room per cycle above which a digest is sent, 0 disables
+        self.maxHosts = maxHosts # hosts listed per section before truncating
+        self.lock = threading.Lock()
+        self.rooms = defaultdict(list)
+
+    # kind is "new", "cleared", "flapping" or "stable" (flapping.py); label is the site/stream shown in the digest title;
+    # ref is handed back by flush() so callers can tell which entries a delivery covered
+    def add(self, roomId, message, kind, label, hostname, eventName, ref=None):
+        with self.lock:
+            self.rooms[roomId].append((message, kind, label, hostname, eventName, ref))
+
+    def formatSection(self, title, entries):
+        lines = [digestLine.format(entry[3], entry[4]) for entry in entries[:self.maxHosts]]
+        if len(entries) > self.maxHosts:
+            lines.append(digestMore.format(len(entries) - self.maxHosts))
+        return digestSection.format(title, len(entries), "\n".join(lines))
+
+    def formatDigest(self, entries):
+        new = [entry for entry in entries if entry[1] == "new"]
+        cleared = [entry for entry in entries if entry[1] == "cleared"]
+        labels = ", ".join(sorted({entry[2] for entry in entries}))
+        digest = digestTitle.format(len(new), len(cleared), labels)
+        if new:
+            digest += self.formatSection("New", new)
+        if cleared:
+            digest += self.formatSection("Resolved", cleared)
+        for kind, title in (("flapping", "Flapping"), ("stable", "No longer flapping")):
+            flaps = [entry for entry in entries if entry[1] == kind]
+            if flaps:
+                digest += self.formatSection(title, flaps)
+        return digest
+
+    # Hand everything held this cycle to send(roomId, **message).
+    # Returns one (send result, refs covered, is digest) tuple per message sent.
+    def flush(self, send):
+        with self.lock:
+            rooms = self.rooms
+            self.rooms = defaultdict(list)
+
+        deliveries = []
+        for roomId, entries in rooms.items():
+            if self.threshold and len(entries) > self.threshold:
+                result = send(roomId, markdown=self.formatDigest(entries))
+                deliveries.append((result, [entry[5] for entry in entries], True))
+            else:
+                for entry in entries:
+                    deliveries.append((send(roomId, **entry[0]), [entry[5]], False))
+        return deliveries
@@ -0,0 +1,381 @@
+#!/usr/bin/env python3
+# Asyncio execution mode for newchecks.py (--async).
+# Zabbix (AsyncZabbixAPI), Postgres (asyncpg) and Webex (aiohttp) calls share one
+# event loop: the host group queries run alongside the main problem fetch, every
+# stream reconciles at once on its own pooled connection, and outbox messages are
+# posted concurrently. Streams, routing maps, message templates, SQL and the outbox
+# table are the same ones the sync engine uses.
+import time
+import signal
+import asyncio
+from collections import defaultdict
+import aiohttp
+import asyncpg
+from zabbix_utils import AsyncZabbixAPI
+
+from settings import (tokenWebex, DatabaseName, DatabaseUsername, DatabasePassword, DatabaseIp, DatabasePort,
+                      DatabaseSchema, WebexApiURL, ZabbixInstances, PollInterval, CycleDeadline, DBPoolSize,
+                      WebexMaxWorkers, WebexRoomConcurrency, WebexMaxRetries, DigestThreshold, DigestMaxHosts,
+                      FlapThreshold, FlapWindow, FlapHoldDown, OutboxBatchSize, OutboxLease, OutboxMaxAttempts,
+                      OutboxBackoffBase, OutboxBackoffMax, OutboxRetentionDays)
+from queries import (snapshotTables, snapshotColumns, snapshotOpenFromRows, watermarkSelect, watermarkUpsert,
+                     disasterParams, eventIdParams, numberedQuery)
+from streams import AlertRow, alertStreams, streamGroups, partitionProblems, highestEvent
+from outbox import outboxInsert, outboxClaim, outboxMarkDelivered, outboxMarkFailed, outboxCleanup
+from alertdigest import AlertDigester
+from webexdispatcher import deliverySummary
+from zabbixinstances import buildInstances, eventidCeilings
+from alertcache import versionBump
+from sharding import streamWait, streamLockKey
+from flapping import (flapRecord, flapStart, flapExpire, flapSettle, routeChanges, flapCounts, flapDecisions,
+                      stableMessages)
+
+
+## Queries - asyncpg versions of the shared SQL
+asyncWatermarkSelect = numberedQuery(watermarkSelect)
+asyncWatermarkUpsert = numberedQuery(watermarkUpsert)
+asyncOutboxInsert = outboxInsert.replace("VALUES %s", "VALUES ($1, $2, $3, $4, $5, $6, $7)")
+asyncOutboxClaim = numberedQuery(outboxClaim)
+asyncOutboxMarkDelivered = numberedQuery(outboxMarkDelivered)
+asyncOutboxMarkFailed = numberedQuery(outboxMarkFailed)
+asyncOutboxCleanup = numberedQuery(outboxCleanup)
+asyncVersionBump = numberedQuery(versionBump)
+asyncStreamWait = numberedQuery(streamWait)
+asyncFlapRecord = numberedQuery(flapRecord)
+asyncFlapStart = numberedQuery(flapStart)
+asyncFlapExpire = numberedQuery(flapExpire)
+
+def asyncpgParams():
+    params = {
+        "database": DatabaseName,
+        "user": DatabaseUsername,
+        "password": DatabasePassword,
+        "host": DatabaseIp,
+        "port": int(DatabasePort) if DatabasePort else None
+    }
+    if DatabaseSchema:
+        params["server_settings"] = {"search_path": DatabaseSchema}
+    return params
+
+
+#########################################WEBEX##################################################
+# Posts messages with aiohttp under an overall and a per-room concurrency limit, pausing
+# every sender for Retry-After when Webex answers 429
+class AsyncWebex:
+    def __init__(self, session, maxWorkers=8, roomConcurrency=1, maxRetries=3):
+        self.session = session
+        self.url = WebexApiURL.rstrip("/") + "/messages"
+        self.limit = asyncio.Semaphore(maxWorkers)
+        self.rooms = defaultdict(lambda: asyncio.Semaphore(roomConcurrency))
+        self.maxRetries = maxRetries
+        self.pausedUntil = 0.0
+        self.resetStats()
+
+    def resetStats(self):
+        self.sent = 0
+        self.failed = 0
+        self.rateLimited = 0
+        self.latencies = []
+        self.queueDelays = []
+
+    # Same contract as WebexDispatcher.send: returns an awaitable resolving to True once delivered
+    def send(self, roomId, **message):
+        return asyncio.ensure_future(self.post(roomId, time.monotonic(), message))
+
+    async def post(self, roomId, queuedAt, message):
+        async with self.rooms[roomId], self.limit:
+            for attempt in range(self.maxRetries + 1):
+                delay = self.pausedUntil - time.monotonic()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                started = time.monotonic()
+                try:
+                    async with self.session.post(self.url, json={"roomId": roomId, **message}) as response:
+                        if response.status == 429:
+                            retryAfter = int(response.headers.get("Retry-After", "1"))
+                            self.rateLimited += 1
+                            self.pausedUntil = max(self.pausedUntil, time.monotonic() + retryAfter)
+                            continue
+                        response.raise_for_status()
+                except aiohttp.ClientError as e:
+                    print(f"Error sending Webex message to room {roomId}: {e}")
+                    break
+                finished = time.monotonic()
+                self.sent += 1
+                self.latencies.append(finished - started)
+                self.queueDelays.append(finished - queuedAt)
+                return True
+        self.failed += 1
+        return False
+
+    def summary(self):
+        return deliverySummary(self.sent, self.failed, self.rateLimited, self.latencies, self.queueDelays)
+
+
+#########################################ENGINE##################################################
+class AsyncEngine:
+    def __init__(self, incremental=False):
+        self.incremental = incremental
+        self.instances = []
+        self.pool = None
+        self.session = None
+        self.webex = None
+        self.digester = AlertDigester(DigestThreshold, DigestMaxHosts)
+        self.watermarks = {} # instance name -> (eventid, clock) of this cycle
+        self.ceilings = {} # instance name -> highest own eventid this cycle saw, caps deleteCleared
+        self.fetchStats = {"requests": 0, "records": 0}
+        self.lastCleanup = 0.0
+
+    # (Re)creating whatever is missing, so a daemon keeps its sessions across cycles
+    async def connect(self):
+        if not self.instances:
+            instances = buildInstances(ZabbixInstances)
+            for instance in instances:
+                instance.api = AsyncZabbixAPI(url=instance.url)
+            await asyncio.gather(*(instance.api.login(token=instance.token) for instance in instances))
+            self.instances = instances
+        if self.pool is None:
+            self.pool = await asyncpg.create_pool(min_size=1, max_size=DBPoolSize, **asyncpgParams())
+        if self.session is None:
+            self.session = aiohttp.ClientSession(headers={"Authorization": f"Bearer {tokenWebex}"})
+            self.webex = AsyncWebex(self.session, WebexMaxWorkers, WebexRoomConcurrency, WebexMaxRetries)
+
+    async def close(self):
+        for instance in self.instances:
+            try:
+                await instance.api.logout()
+            except Exception:
+                pass
+        self.instances = []
+        if self.pool is not None:
+            await self.pool.close()
+            self.pool = None
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+            self.webex = None
+
+    async def problemGet(self, instance, params):
+        result = await instance.api.problem.get(params)
+        self.fetchStats["requests"] += 1
+        self.fetchStats["records"] += len(result)
+        return result
+
+    # Lowest watermark across the streams per instance, 0 means full fetch
+    async def loadWatermarks(self):
+        keys = [instance.watermarkKey(stream.name) for instance in self.instances for stream in alertStreams]
+        try:
+            stored = {row[0]: int(row[1]) for row in await self.pool.fetch(asyncWatermarkSelect, keys)}
+        except asyncpg.PostgresError as e:
+            print(f"Error getting watermarks from DB, doing a full fetch: {e}")
+            stored = {}
+        watermarks = {}
+        for instance in self.instances:
+            streamMarks = [stored.get(instance.watermarkKey(stream.name)) for stream in alertStreams]
+            watermarks[instance.name] = 0 if None in streamMarks else min(streamMarks)
+        return watermarks
+
+    # One instance's requests (newchecks.fetchCycleScope + its problem fetch), sent concurrently.
+    # Incremental mode gets the open ids first and fetches problems only up to the last of them,
+    # like newchecks.fetchCycleScope, so a problem opened meanwhile is left to the next cycle.
+    async def fetchInstance(self, instance, watermark, groups):
+        params = disasterParams()
+        openIds = None
+        if self.incremental:
+            openProblems = await self.problemGet(instance, eventIdParams())
+            openIds = instance.qualifyIds(openProblems)
+            lastEventid = max((int(element["eventid"]) for element in openProblems), default=watermark)
+            params = disasterParams(watermark + 1, eventidTill=lastEventid)
+            self.ceilings[instance.name] = lastEventid
+        requests = [self.problemGet(instance, params)]
+        requests += [self.problemGet(instance, eventIdParams(instance.groupid(groupid))) for groupid in groups]
+        results = await asyncio.gather(*requests)
+
+        problems = results[0]
+        eventid, clock = highestEvent(problems)
+        if eventid is not None:
+            self.watermarks[instance.name] = (eventid, clock)
+            self.ceilings[instance.name] = max(eventid, self.ceilings.get(instance.name, eventid))
+        groupMembers = {groupid: instance.qualifyIds(result) for groupid, result in zip(groups, results[1:])}
+        return instance.qualifyProblems(problems), groupMembers, openIds
+
+    # Every instance at once, merged with instance-qualified eventids
+    async def fetchCycleProblems(self):
+        groups = streamGroups()
+        self.watermarks = {}
+        self.ceilings = {}
+        watermarks = await self.loadWatermarks() if self.incremental else {}
+        results = await asyncio.gather(*(self.fetchInstance(instance, watermarks.get(instance.name, 0), groups)
+                                         for instance in self.instances))
+
+        problems = []
+        groupMembers = {groupid: set() for groupid in groups}
+        openIds = set() if self.incremental else None
+        for instanceProblems, instanceMembers, instanceOpenIds in results:
+            problems.extend(instanceProblems)
+            for groupid, members in instanceMembers.items():
+                groupMembers[groupid] |= members
+            if self.incremental:
+                openIds |= instanceOpenIds
+        return partitionProblems(problems, groupMembers, openIds)
+
+    # newchecks.reconcileStream on asyncpg: the snapshot is loaded with COPY instead of multi-row INSERTs
+    async def reconcileStream(self, stream, streamProblems, openIds):
+        started = time.monotonic()
+        rows = stream.prepare(streamProblems)
+        try:
+            async with self.pool.acquire() as dbconn:
+                async with dbconn.transaction():
+                    await dbconn.execute(snapshotTables)
+                    await dbconn.copy_records_to_table("zabbix_rows", records=rows, columns=snapshotColumns.split(", "))
+                    if openIds is None:
+                        await dbconn.execute(snapshotOpenFromRows)
+                    else:
+                        await dbconn.copy_records_to_table("zabbix_open", records=[(eventid,) for eventid in openIds], columns=["eventid"])
+
+                    # Same stream lock as the sync engine and webhook.py, for the statements that write
+                    await dbconn.execute(asyncStreamWait, streamLockKey(stream.name))
+                    changes = []
+                    ceilings = eventidCeilings(self.instances, self.ceilings)
+                    for kind, query, params in (("new", stream.insertNew, ()), ("cleared", numberedQuery(stream.deleteCleared), (ceilings,))):
+                        changes.extend((kind, row) for row in map(AlertRow._make, await dbconn.fetch(query, *params)))
+
+                    if openIds is not None:
+                        for instance in self.instances:
+                            if instance.name in self.watermarks:
+                                eventid, clock = self.watermarks[instance.name]
+                                await dbconn.execute(asyncWatermarkUpsert, instance.watermarkKey(stream.name), eventid, clock)
+
+                    # Notifications go to the outbox in the same transaction as the alert rows, minus flapping ones
+                    outgoing = []
+                    for room_id, message, kind, label, hostname, name in await self.filterFlapping(dbconn, stream, changes):
+                        msgFormat, body = next(iter(message.items()))
+                        outgoing.append((room_id, msgFormat, body, kind, label, hostname, name))
+                    if outgoing:
+                        await dbconn.executemany(asyncOutboxInsert, outgoing)
+                    if changes:
+                        await dbconn.execute(asyncVersionBump, stream.name)
+        except Exception as e:
+            print(f"Error during reconcile of {stream.name} stream: {e}")
+        return time.monotonic() - started
+
+    # flapping.filterFlapping followed by settleFlapping, on asyncpg
+    async def filterFlapping(self, dbconn, stream, changes):
+        if not FlapThreshold:
+            return routeChanges(stream, changes)
+        counts = flapCounts(stream, changes)
+        state = {}
+        if counts:
+            sites, hostnames, names = zip(*counts)
+            records = await dbconn.fetch(asyncFlapRecord, stream.name, list(sites), list(hostnames), list(names),
+                                         list(counts.values()), float(FlapWindow), float(FlapWindow))
+            state = {(site, hostname, name): (count, flapping) for site, hostname, name, count, flapping in records}
+
+        outgoing, started = flapDecisions(stream, changes, state, FlapThreshold, FlapWindow, FlapHoldDown)
+        if started:
+            sites, hostnames, names = zip(*started)
+            await dbconn.execute(asyncFlapStart, stream.name, list(sites), list(hostnames), list(names))
+            outgoing.extend(started.values())
+        settled = await dbconn.fetch(numberedQuery(flapSettle(stream)), stream.name, float(FlapHoldDown))
+        outgoing += stableMessages(stream, settled, FlapHoldDown)
+        await dbconn.execute(asyncFlapExpire, stream.name, float(FlapWindow))
+        return outgoing
+
+    # outbox.deliverOutbox with every message of a batch in flight at once
+    async def deliverPending(self):
+        totals = [0, 0, 0, 0]
+        while True:
+            try:
+                rows = await self.pool.fetch(asyncOutboxClaim, float(OutboxLease), OutboxMaxAttempts, OutboxBatchSize)
+            except asyncpg.PostgresError as e:
+                print(f"Error claiming Webex outbox rows: {e}")
+                break
+            if not rows:
+                break
+
+            for row in sorted(rows, key=lambda row: row[0]):
+                self.digester.add(row[1], {row[2]: row[3]}, row[4], row[5], row[6], row[7], ref=row[0])
+            deliveries = self.digester.flush(self.webex.send)
+            results = await asyncio.gather(*(result for result, refs, isDigest in deliveries))
+
+            delivered = []
+            failed = []
+            for ok, (result, refs, isDigest) in zip(results, deliveries):
+                if ok:
+                    delivered.extend(refs)
+                else:
+                    failed.extend(refs)
+                totals[3 if isDigest else 2] += 1
+            try:
+                if delivered:
+                    await self.pool.execute(asyncOutboxMarkDelivered, delivered)
+                if failed:
+                    await self.pool.execute(asyncOutboxMarkFailed, float(OutboxBackoffBase), float(OutboxBackoffMax),
+                                            "Webex delivery failed", failed)
+            except asyncpg.PostgresError as e:
+                # Rows stay claimed until the lease runs out and are retried then
+                print(f"Error updating Webex outbox rows: {e}")
+            totals[0] += len(delivered)
+            totals[1] += len(failed)
+
+            if len(rows) < OutboxBatchSize:
+                break
+
+        if time.monotonic() - self.lastCleanup > 3600:
+            try:
+                await self.pool.execute(asyncOutboxCleanup, OutboxRetentionDays)
+                self.lastCleanup = time.monotonic()
+            except asyncpg.PostgresError as e:
+                print(f"Error cleaning up Webex outbox: {e}")
+        return tuple(totals)
+
+    async def runCycle(self):
+        for key in self.fetchStats:
+            self.fetchStats[key] = 0
+        cycleProblems = await self.fetchCycleProblems()
+        print(f"Zabbix fetch: {self.fetchStats['requests']} requests, {self.fetchStats['records']} records")
+
+        tasks = {asyncio.ensure_future(self.reconcileStream(stream, *cycleProblems[stream.name])): stream.name for stream in alertStreams}
+        done, late = await asyncio.wait(tasks, timeout=CycleDeadline)
+        timings = {tasks[task]: f"{task.result():.2f}s" for task in done}
+        for task in late:
+            task.cancel()
+            timings[tasks[task]] = f"cancelled after {CycleDeadline}s"
+        print("Stream timings: " + ", ".join(f"{name} {timing}" for name, timing in timings.items()))
+
+        delivered, failed, messages, digests = await self.deliverPending()
+        if delivered or failed:
+            print(f"Outbox: {delivered} delivered, {failed} failed, {messages} single messages, {digests} digests")
+            print(self.webex.summary())
+            self.webex.resetStats()
+
+
+async def runAsync(incremental=False, daemon=False, interval=PollInterval):
+    engine = AsyncEngine(incremental)
+    stopEvent = asyncio.Event()
+    if daemon:
+        loop = asyncio.get_running_loop()
+        loop.add_signal_handler(signal.SIGTERM, stopEvent.set)
+        loop.add_signal_handler(signal.SIGINT, stopEvent.set)
+
+    try:
+        while not stopEvent.is_set():
+            started = time.monotonic()
+            try:
+                await engine.connect()
+                await engine.runCycle()
+            except Exception as e:
+                # Drop every session so the next cycle starts from fresh connections
+                print(f"Error during async cycle: {e}")
+                await engine.close()
+            if not daemon:
+                break
+            try:
+                await asyncio.wait_for(stopEvent.wait(), max(0, interval - (time.monotonic() - started)))
+            except asyncio.TimeoutError:
+                pass
+    finally:
+        await engine.close()
+
+def main(incremental=False, daemon=False, interval=PollInterval):
+    asyncio.run(runAsync(incremental, daemon, interval))
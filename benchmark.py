@@ -0,0 +1,704 @@
+#!/usr/bin/env python3
+# Benchmarks for newchecks.py.
+# Runs against the database configured in .env, but only inside the throwaway
+# schema below (created and dropped here), so production rows are never touched.
+# Zabbix and Webex are replaced by local stand-in servers for the engine comparison and the
+# --scenarios suite (full cycles with churn, injected Webex latency and 429s, peak RSS).
+# --cold-start times cli.py's subcommands in fresh processes and needs neither.
+# --check runs full and incremental cycles against the stand-ins and fails on any mismatch.
+import io
+import os
+import sys
+import json
+import time
+import argparse
+import resource
+import statistics
+import subprocess
+import contextlib
+import urllib.request
+import multiprocessing
+import threading
+import tracemalloc
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import psycopg2 as p
+import psycopg2.extensions
+from psycopg2.extras import execute_values
+
+import newchecks
+import streams
+import database
+import schema
+import metrics
+from webexdispatcher import WebexDispatcher
+from zabbixinstances import ZabbixInstance
+from alertcache import AlertCache
+
+BenchSchema = "zabbixbench"
+benchSites = ["SJC", "RTP", "LON", "SNG", "SYD"]
+
+
+# Counting every statement sent to the server (execute_values sends one per page)
+class CountingCursor(psycopg2.extensions.cursor):
+    roundTrips = 0
+
+    def execute(self, query, vars=None):
+        CountingCursor.roundTrips += 1
+        return super().execute(query, vars)
+
+
+# Stand-in for WebexTeamsAPI that only counts messages
+class FakeMessages:
+    def __init__(self):
+        self.sent = 0
+
+    def create(self, **kwargs):
+        self.sent += 1
+
+class FakeWebex:
+    def __init__(self):
+        self.messages = FakeMessages()
+
+
+#########################################SCHEMA##################################################
+# Fresh bench schema with the production tables (schema.migrate runs on the bench search_path)
+def resetSchema(conn):
+    cur = conn.cursor()
+    cur.execute(f"DROP SCHEMA IF EXISTS {BenchSchema} CASCADE; CREATE SCHEMA {BenchSchema};")
+    conn.commit()
+    cur.close()
+    schema.migrate(conn)
+
+def dropSchema(conn):
+    cur = conn.cursor()
+    cur.execute(f"DROP SCHEMA IF EXISTS {BenchSchema} CASCADE;")
+    conn.commit()
+    cur.close()
+
+# Every connection the engines open lands in the bench schema
+def openBenchDatabase(cursor_factory=None):
+    database.databaseParams["options"] = f"-c search_path={BenchSchema}"
+    return p.connect(connection_factory=database.PreparingConnection, cursor_factory=cursor_factory, **database.databaseParams)
+
+
+#########################################DATA##################################################
+def siteRow(eventid):
+    return [eventid, "Site down", 1700000000 + eventid, "SJC", f"host-{eventid}"]
+
+# Database holds `size` alerts, Zabbix clears `churn` of them and raises `churn` new ones
+def buildScenario(size, churn):
+    existing = [siteRow(eventid) for eventid in range(1, size + 1)]
+    zabbixData = existing[churn:] + [siteRow(eventid) for eventid in range(size + 1, size + churn + 1)]
+    return existing, zabbixData
+
+def seedTable(conn, existing):
+    resetSchema(conn)
+    cur = conn.cursor()
+    execute_values(cur, "INSERT INTO sitealerts (eventid, name, clock, site, hostname) VALUES %s", existing,
+                   template="(%s, %s, to_timestamp(%s), %s, %s)")
+    conn.commit()
+    cur.close()
+
+
+#########################################LEGACY##################################################
+# Per-eventid reconciliation as newchecks.py did it before the set-based rewrite
+def legacyAlertCheckingSites(conn, zabbixData):
+    cur = conn.cursor()
+    cur.execute("SELECT eventid FROM sitealerts;")
+    postgres_ids = {int(item[0]) for item in cur.fetchall()}
+    zabbix_ids = {int(item[0]) for item in zabbixData}
+
+    newAlert = zabbix_ids - postgres_ids
+    clearAlert = postgres_ids - zabbix_ids
+
+    for element in zabbixData:
+        if int(element[0]) in newAlert:
+            cur.execute("INSERT INTO sitealerts (eventid, name, clock, site, hostname) VALUES (%s, %s, to_timestamp(%s), %s, %s);", tuple(element))
+            newchecks.apiWebex.messages.create(roomId=None, text="")
+
+    for id in clearAlert:
+        cur.execute("SELECT * FROM sitealerts WHERE eventid=(%s)", (id,))
+        for alert in cur.fetchall():
+            newchecks.apiWebex.messages.create(roomId=None, markdown="")
+        cur.execute("DELETE FROM sitealerts WHERE eventid = (%s)", (id,))
+
+    conn.commit()
+    cur.close()
+
+
+#########################################STREAMS##################################################
+# Stand-in for ZabbixAPI.problem serving `size` synthetic problems spread over `groups` host groups
+# (ids 1000, 1001, ... unless groupids names them). churn() clears the oldest problems and raises
+# as many new ones, like a Zabbix server between two cycles.
+class FakeProblemAPI:
+    def __init__(self, size, groups, groupids=None):
+        self.groupids = groupids or [1000 + index for index in range(groups)]
+        self.problems = []
+        self.nextEventid = 1
+        self.raiseProblems(size)
+
+    def raiseProblems(self, count):
+        for eventid in range(self.nextEventid, self.nextEventid + count):
+            self.problems.append({
+                "eventid": str(eventid),
+                "name": "VMware: Hypervisor is down" if eventid % 10 == 0 else "Site down",
+                "clock": str(1700000000 + eventid),
+                "groupid": self.groupids[eventid % len(self.groupids)],
+                "tags": [
+                    {"tag": "site", "value": benchSites[eventid % len(benchSites)]},
+                    {"tag": "visname", "value": f"vis-{eventid}"},
+                    {"tag": "hostname", "value": f"host-{eventid}"},
+                ],
+            })
+        self.nextEventid += count
+
+    def churn(self, count):
+        del self.problems[:count]
+        self.raiseProblems(count)
+
+    def get(self, params):
+        result = self.problems
+        if "groupids" in params:
+            result = [element for element in result if element["groupid"] in params["groupids"]]
+        if "eventid_from" in params:
+            result = [element for element in result if int(element["eventid"]) >= int(params["eventid_from"])]
+        if "eventid_till" in params:
+            result = [element for element in result if int(element["eventid"]) <= int(params["eventid_till"])]
+        if "limit" in params:
+            result = result[:params["limit"]]
+        fields = params["output"] + (["tags"] if "selectTags" in params else [])
+        return [{field: element[field] for field in fields} for element in result]
+
+class FakeZabbix:
+    def __init__(self, size, groups):
+        self.problem = FakeProblemAPI(size, groups)
+
+# Fetch + partition + prepare cost with 1..N registered streams, all from the shared paged fetch.
+# Peak is the Python memory allocated while the pages are consumed (tracemalloc).
+def benchStreams(size, streamCounts, pageSizes):
+    print(f"Stream fan-out ({size} problems)")
+    saved = list(streams.alertStreams)
+    savedPageSize = newchecks.ZabbixPageSize
+    instance = ZabbixInstance("bench", 0, None, None)
+    instance.api = FakeZabbix(size, max(streamCounts))
+    newchecks.zabbixInstances = [instance]
+    newchecks.fetchSizes = True
+    try:
+        for pageSize in pageSizes:
+            newchecks.ZabbixPageSize = pageSize
+            for count in streamCounts:
+                streams.alertStreams[:] = [saved[0]] + [
+                    streams.AlertStream(f"bench{index}", f"bench{index}alerts", streams.routeSite, groupid=1000 + index,
+                                        siteTag="site", siteDefault="UNKNOWN", hostTag="visname", hostDefault="UNKNOWN")
+                    for index in range(count - 1)]
+                newchecks.resetFetchStats()
+                tracemalloc.start()
+                started = time.perf_counter()
+                params, groupMembers, streamOpenIds = newchecks.fetchCycleScope()
+                rows = 0
+                for page in newchecks.cyclePages(params):
+                    pageProblems = streams.partitionProblems(page, groupMembers)
+                    rows += sum(len(stream.prepare(pageProblems[stream.name][0])) for stream in streams.alertStreams)
+                elapsed = time.perf_counter() - started
+                peak = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+                print(f"  page {pageSize or 'all':>5}  {count:>3} streams  {newchecks.fetchStats['requests']:>4} requests  "
+                      f"{newchecks.fetchStats['bytes']:>10} bytes  {rows:>7} rows  {elapsed * 1000:>8.1f} ms  peak {peak / 1024:>8.0f} KiB")
+    finally:
+        streams.alertStreams[:] = saved
+        newchecks.ZabbixPageSize = savedPageSize
+        newchecks.fetchSizes = False
+        newchecks.closeServices()
+
+
+#########################################RECORDS##################################################
+# Site problem parsing as newchecks.py did it before AlertRow: a tags dict per problem,
+# positional lists with string ids, int() again wherever ids are compared
+def legacySiteProblems(problems):
+    data = []
+    for element in problems:
+        tags_dict = {tag['tag']: tag['value'] for tag in element.get('tags', [])}
+        site = tags_dict.get("site", "UNKNOWN")
+        visname = tags_dict.get("visname", "UNKNOWN")
+        data.append([element["eventid"], element["name"], element["clock"], site, visname])
+    return data, {int(item[0]) for item in data}
+
+def alertRowProblems(problems, stream):
+    data = stream.prepare(problems)
+    return data, {row.eventid for row in data}
+
+# Parse time and the memory the rows (plus the id set the reconcilers build) keep once the
+# decoded response is dropped, per 100k problems
+def benchRecords(count):
+    response = json.dumps(FakeProblemAPI(count, 1).get({"output": ["eventid", "name", "clock"], "selectTags": "extend"}))
+    siteStream = next(stream for stream in streams.alertStreams if stream.name == "site")
+    print(f"Problem records ({count} problems, figures per 100k)")
+    for label, parse in (("lists", legacySiteProblems), ("AlertRow", lambda problems: alertRowProblems(problems, siteStream))):
+        problems = json.loads(response)
+        started = time.perf_counter()
+        parse(problems)
+        elapsed = time.perf_counter() - started
+
+        tracemalloc.start()
+        problems = json.loads(response)
+        result = parse(problems)
+        del problems
+        retained = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        del result
+        scale = 100000 / count
+        print(f"  {label:<10} {elapsed * 1000 * scale:>8.1f} ms  {retained / 1024 / 1024 * scale:>7.1f} MiB")
+
+
+#########################################RECONCILE##################################################
+# warm runs after seeding and before the counters start (e.g. loading the alert cache)
+def measure(label, conn, existing, reconcile, warm=None):
+    seedTable(conn, existing)
+    if warm is not None:
+        warm()
+    newchecks.apiWebex = FakeWebex()
+    newchecks.dispatcher = WebexDispatcher(newchecks.apiWebex)
+    CountingCursor.roundTrips = 0
+    database.resetQueryStats()
+    started = time.perf_counter()
+    reconcile()
+    newchecks.dispatcher.shutdown()
+    elapsed = time.perf_counter() - started
+    sent = newchecks.apiWebex.messages.sent
+    # Shut down, so connectServices() has to create a real one for the benchmarks that follow
+    newchecks.dispatcher = None
+    newchecks.apiWebex = None
+    print(f"  {label:<10} {CountingCursor.roundTrips:>7} round trips  {elapsed * 1000:>9.1f} ms  {sent:>6} messages")
+    if database.queryStats:
+        print(f"    {database.queryStatsSummary()}")
+
+# The daemon's steady state: open ids already cached from the previous cycle
+def warmCache(conn, stream):
+    newchecks.alertCache.invalidate()
+    cur = conn.cursor()
+    newchecks.alertCache.known(cur, stream)
+    cur.close()
+    conn.commit()
+
+def benchReconcile(sizes, churnRatio):
+    conn = openBenchDatabase(CountingCursor)
+    newchecks.conn = conn
+    siteStream = next(stream for stream in streams.alertStreams if stream.name == "site")
+    print("Reconciliation round trips (sitealerts)")
+    try:
+        for size in sizes:
+            churn = max(1, int(size * churnRatio))
+            existing, zabbixData = buildScenario(size, churn)
+            print(f" {size} open alerts, {churn} new + {churn} cleared")
+            measure("legacy", conn, existing, lambda: legacyAlertCheckingSites(conn, zabbixData))
+            rows = [streams.AlertRow(*element) for element in zabbixData]
+            setBased = lambda: (newchecks.reconcileStream(siteStream, rows), newchecks.deliverPending(conn))
+            database.DBPreparedStatements = False
+            measure("set-based", conn, existing, setBased)
+            database.DBPreparedStatements = True
+            measure("prepared", conn, existing, setBased)
+            newchecks.alertCache = AlertCache()
+            measure("cached", conn, existing, setBased, lambda: warmCache(conn, siteStream))
+            newchecks.alertCache = None
+    finally:
+        newchecks.conn = None
+        newchecks.alertCache = None
+        dropSchema(conn)
+        conn.close()
+
+
+#########################################ENGINES##################################################
+# JSON-RPC for Zabbix (/api_jsonrpc.php) and the Webex messages endpoint (/v1/messages)
+class StandInHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        if self.path.endswith("api_jsonrpc.php"):
+            if body.get("method") == "problem.get":
+                time.sleep(self.server.zabbixLatency)
+            self.reply(200, {"jsonrpc": "2.0", "result": self.server.zabbixCall(body), "id": body.get("id")})
+        elif self.path.endswith("/messages"):
+            time.sleep(self.server.webexLatency)
+            with self.server.lock:
+                self.server.requests += 1
+                limited = self.server.rateLimitEvery and self.server.requests % self.server.rateLimitEvery == 0
+                if limited:
+                    self.server.rateLimited += 1
+                else:
+                    self.server.messages += 1
+            if limited:
+                self.reply(429, {"message": "Too Many Requests"}, {"Retry-After": str(self.server.retryAfter)})
+            else:
+                self.reply(200, {"id": str(self.server.messages), "roomId": body.get("roomId")})
+        elif self.path == "/bench/churn":
+            with self.server.lock:
+                self.server.problemAPI.churn(body["count"])
+            self.reply(200, {})
+        else:
+            self.reply(404, {})
+
+    # Counters for a benchmark running in another process
+    def do_GET(self):
+        if self.path == "/bench/stats":
+            with self.server.lock:
+                self.reply(200, {"messages": self.server.messages, "rateLimited": self.server.rateLimited})
+        else:
+            self.reply(404, {})
+
+    def reply(self, status, payload, headers=None):
+        data = json.dumps(payload).encode()
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+class StandInServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    # Every rateLimitEvery-th Webex request is answered 429 with Retry-After: retryAfter
+    def __init__(self, size, webexLatency=0.0, zabbixLatency=0.0, rateLimitEvery=0, retryAfter=1):
+        super().__init__(("127.0.0.1", 0), StandInHandler)
+        self.zabbixLatency = zabbixLatency
+        # Problems alternate between the site and CPOC host groups
+        self.problemAPI = FakeProblemAPI(size, 2, [streams.SiteGroupID, streams.CPOCGroupID])
+        self.webexLatency = webexLatency
+        self.rateLimitEvery = rateLimitEvery
+        self.retryAfter = retryAfter
+        self.raiseBeforePages = 0 # problems opened right before the next problem page is answered
+        self.requests = 0
+        self.messages = 0
+        self.rateLimited = 0
+        self.lock = threading.Lock()
+        self.url = f"http://127.0.0.1:{self.server_address[1]}"
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    def zabbixCall(self, body):
+        method = body.get("method")
+        params = body.get("params") or {}
+        if method == "apiinfo.version":
+            return "7.0.0"
+        if method == "problem.get":
+            with self.lock:
+                if self.raiseBeforePages and "name" in params.get("output", ()):
+                    self.problemAPI.raiseProblems(self.raiseBeforePages)
+                    self.raiseBeforePages = 0
+                return self.problemAPI.get(params)
+        if method == "user.checkAuthentication":
+            return {"userid": "1"}
+        if method == "user.logout":
+            return True
+        return []
+
+def standInInstance(name, url):
+    return {"name": name, "url": url, "token": "bench", "groupMap": {}}
+
+# Scope queries plus all problem pages from 1..N stand-in Zabbix servers, each answering
+# problem.get after `latency` seconds; polled concurrently this should stay near one server's time
+def benchInstances(size, instanceCounts, latency):
+    print(f"Zabbix instances ({size} problems each, {latency * 1000:.0f} ms per problem.get)")
+    servers = [StandInServer(size, zabbixLatency=latency) for count in range(max(instanceCounts))]
+    try:
+        for count in instanceCounts:
+            newchecks.ZabbixInstances = [standInInstance(f"bench{index}", server.url) for index, server in enumerate(servers[:count])]
+            newchecks.connectZabbix()
+            newchecks.resetFetchStats()
+            started = time.perf_counter()
+            params, groupMembers, streamOpenIds = newchecks.fetchCycleScope()
+            problems = sum(len(page) for page in newchecks.cyclePages(params))
+            elapsed = time.perf_counter() - started
+            newchecks.closeServices()
+            print(f"  {count:>3} instances  {newchecks.fetchStats['requests']:>4} requests  {problems:>8} problems  {elapsed:>7.2f} s")
+    finally:
+        for server in servers:
+            server.shutdown()
+
+# One full cycle per engine from empty tables: fetch, reconcile every stream, deliver the outbox
+def benchEngines(size, webexLatency):
+    import asyncengine
+    server = StandInServer(size, webexLatency)
+    for module in (newchecks, asyncengine):
+        module.ZabbixInstances = [standInInstance("main", server.url)]
+        module.WebexApiURL = server.url + "/v1/"
+    asyncengine.DatabaseSchema = BenchSchema
+    conn = openBenchDatabase()
+    print(f"Sync vs asyncio engine ({size} problems, {webexLatency * 1000:.0f} ms Webex latency)")
+    try:
+        for label in ("sync", "asyncio"):
+            resetSchema(conn)
+            server.messages = 0
+            started = time.perf_counter()
+            if label == "sync":
+                newchecks.connectServices()
+                try:
+                    newchecks.runCycle()
+                finally:
+                    newchecks.closeServices()
+            else:
+                engine = asyncengine.AsyncEngine()
+                engine.digester.threshold = 0
+                async def cycle():
+                    try:
+                        await engine.connect()
+                        await engine.runCycle()
+                    finally:
+                        await engine.close()
+                asyncengine.asyncio.run(cycle())
+            elapsed = time.perf_counter() - started
+            print(f"  {label:<8} {elapsed:>8.2f} s  {server.messages:>6} messages")
+    finally:
+        dropSchema(conn)
+        conn.close()
+        server.shutdown()
+
+
+#########################################SCENARIOS##################################################
+# Fixed, distinct rooms per site instead of the .env ones, so messages spread over rooms (and
+# digests form) the same way on every machine
+def useBenchRooms():
+    for site in benchSites:
+        streams.siteRoomMap[site] = f"bench-{site.lower()}"
+    streams.WebexRoomID = "bench-general"
+    streams.CPOCRoomID = "bench-cpoc"
+    streams.ADMINRoomID = metrics.ADMINRoomID = "bench-admin"
+
+def standInRequest(url, path, payload=None):
+    data = json.dumps(payload).encode() if payload is not None else None
+    with urllib.request.urlopen(urllib.request.Request(url + path, data=data)) as response:
+        return json.loads(response.read())
+
+# Runs in a spawned process, so its peak RSS is the engine's alone (the stand-ins stay in the
+# parent). Daemon-style cycles against the stand-in at url: the first from empty tables, each
+# later one after `churn` problems were cleared and raised. Puts one result per cycle, then None.
+def cycleScenario(url, churn, cycles, digestThreshold, results):
+    conn = None
+    try:
+        useBenchRooms()
+        newchecks.digester.threshold = digestThreshold
+        newchecks.ZabbixInstances = [standInInstance("main", url)]
+        newchecks.WebexApiURL = url + "/v1/"
+        newchecks.tokenWebex = newchecks.tokenWebex or "bench"
+        newchecks.alertCache = newchecks.AlertCache(newchecks.AlertCacheRefresh or 3600)
+        conn = openBenchDatabase()
+        resetSchema(conn)
+        database.databaseParams["cursor_factory"] = CountingCursor
+        for cycle in range(cycles):
+            if cycle:
+                standInRequest(url, "/bench/churn", {"count": churn})
+            before = standInRequest(url, "/bench/stats")
+            CountingCursor.roundTrips = 0
+            started = time.perf_counter()
+            with contextlib.redirect_stdout(io.StringIO()):
+                newchecks.connectServices()
+                newchecks.runCycle()
+            elapsed = time.perf_counter() - started
+            after = standInRequest(url, "/bench/stats")
+            results.put({"cycle": cycle, "seconds": elapsed, "roundTrips": CountingCursor.roundTrips,
+                         "messages": after["messages"] - before["messages"],
+                         "rateLimited": after["rateLimited"] - before["rateLimited"],
+                         "peakRss": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss})
+        newchecks.closeServices()
+    except Exception as e:
+        results.put({"error": str(e)})
+    finally:
+        database.databaseParams.pop("cursor_factory", None)
+        if conn is not None:
+            dropSchema(conn)
+            conn.close()
+        results.put(None)
+
+# Full sync-engine cycles per scenario size: cycle time, DB round trips, Webex messages
+# (storm digests included) and the cycle process's peak RSS
+def benchScenarios(sizes, churnRatio, cycles, webexLatency, rateLimitEvery, retryAfter, digestThreshold):
+    print(f"Cycle scenarios ({cycles} cycles, {churnRatio:.0%} churn, {webexLatency * 1000:.0f} ms Webex latency, "
+          f"429 every {rateLimitEvery or 'never'}, digest above {digestThreshold or 'never'})")
+    context = multiprocessing.get_context("spawn")
+    for size in sizes:
+        server = StandInServer(size, webexLatency, rateLimitEvery=rateLimitEvery, retryAfter=retryAfter)
+        results = context.Queue()
+        child = context.Process(target=cycleScenario, args=(server.url, max(1, int(size * churnRatio)), cycles, digestThreshold, results))
+        child.start()
+        print(f" {size} problems")
+        try:
+            for result in iter(results.get, None):
+                if "error" in result:
+                    print(f"  failed: {result['error']}")
+                    continue
+                label = "initial" if result["cycle"] == 0 else f"churn {result['cycle']}"
+                print(f"  {label:<9} {result['seconds']:>8.2f} s  {result['roundTrips']:>6} round trips  "
+                      f"{result['messages']:>6} messages  {result['rateLimited']:>4} 429s  peak RSS {result['peakRss'] / 1024:>7.1f} MiB")
+        finally:
+            child.join()
+            server.shutdown()
+
+
+#########################################CHECK##################################################
+# Open eventids per stream the way the stand-in's problems should end up in the alert tables
+def expectedAlerts(problemAPI):
+    expected = {}
+    for stream in streams.alertStreams:
+        problems = [element for element in problemAPI.problems if stream.groupid in (None, element["groupid"])]
+        expected[stream.name] = {row.eventid for row in stream.prepare(problems)}
+    return expected
+
+def storedAlerts(conn):
+    cur = conn.cursor()
+    stored = {}
+    for stream in streams.alertStreams:
+        cur.execute(f"SELECT eventid FROM {stream.table};")
+        stored[stream.name] = {eventid for eventid, in cur.fetchall()}
+    cur.execute("SELECT count(*) FROM webexoutbox WHERE delivered IS NULL;")
+    pending = cur.fetchone()[0]
+    conn.commit()
+    cur.close()
+    return stored, pending
+
+# End-to-end check of the sync engine against the stand-ins, full and incremental fetch: every
+# cycle must leave each alert table holding exactly its stream's open problems, without failed
+# reconciles, with one Webex message per stored or deleted alert and nothing left in the outbox.
+# Churn cycles but the last also open problems between the id-only queries and the problem
+# pages; those may wait for the next cycle, so only the last cycle has to match them exactly.
+# Returns the number of failed checks.
+def checkCycles(size, churn, cycles):
+    print(f"End-to-end check ({size} problems, {churn} cleared and raised per cycle, {cycles} cycles)")
+    failures = 0
+    savedIncremental, savedThreshold = newchecks.IncrementalFetch, newchecks.digester.threshold
+    newchecks.digester.threshold = 0 # one message per alert, so they can be counted
+    useBenchRooms()
+    conn = openBenchDatabase()
+    try:
+        for incremental in (False, True):
+            server = StandInServer(size)
+            newchecks.ZabbixInstances = [standInInstance("main", server.url)]
+            newchecks.WebexApiURL = server.url + "/v1/"
+            newchecks.tokenWebex = newchecks.tokenWebex or "bench"
+            newchecks.IncrementalFetch = incremental
+            resetSchema(conn)
+            stored = {stream.name: set() for stream in streams.alertStreams}
+            try:
+                for cycle in range(cycles):
+                    if cycle:
+                        with server.lock:
+                            server.problemAPI.churn(churn)
+                            server.raiseBeforePages = 0 if cycle == cycles - 1 else max(1, churn // 2)
+                    with server.lock:
+                        expected = expectedAlerts(server.problemAPI)
+                        messagesBefore = server.messages
+                    failedBefore = sum(metrics.reconcileFailures.values.values())
+                    with contextlib.redirect_stdout(io.StringIO()):
+                        newchecks.connectServices()
+                        try:
+                            newchecks.runCycle()
+                        finally:
+                            newchecks.closeServices()
+                    previous = stored
+                    stored, pending = storedAlerts(conn)
+                    with server.lock:
+                        late = {name: ids - expected[name] for name, ids in expectedAlerts(server.problemAPI).items()}
+                    changes = sum(len(stored[name] ^ previous[name]) for name in stored)
+                    problems = []
+                    if sum(metrics.reconcileFailures.values.values()) != failedBefore:
+                        problems.append("reconcile rolled back")
+                    for name in expected:
+                        if stored[name] - late[name] != expected[name] or not stored[name] <= expected[name] | late[name]:
+                            problems.append(f"{name}: {len(expected[name] - stored[name])} missing, {len(stored[name] - expected[name] - late[name])} stale")
+                    if server.messages - messagesBefore != changes:
+                        problems.append(f"{server.messages - messagesBefore} messages for {changes} stored changes")
+                    if pending:
+                        problems.append(f"{pending} outbox rows undelivered")
+                    label = f"{'incremental' if incremental else 'full'} {'initial' if cycle == 0 else f'churn {cycle}'}"
+                    print(f"  {label:<20} {'ok' if not problems else 'FAILED: ' + '; '.join(problems)}")
+                    failures += bool(problems)
+            finally:
+                server.shutdown()
+    finally:
+        newchecks.IncrementalFetch, newchecks.digester.threshold = savedIncremental, savedThreshold
+        dropSchema(conn)
+        conn.close()
+    return failures
+
+
+# Run in a fresh interpreter: loads a cli.py subcommand and reports the import time and which
+# heavy packages came with it. "eager" loads everything newchecks.py used to import up front.
+coldStartProbe = """import sys, json, time
+started = time.perf_counter()
+import cli
+if sys.argv[1] == "eager":
+    import newchecks, webexdispatcher, webhook, webexteamssdk, zabbix_utils
+else:
+    cli.loadCommand(sys.argv[1])
+print(json.dumps({"imports": time.perf_counter() - started,
+                  "loaded": [name for name in ("psycopg2", "webexteamssdk", "zabbix_utils") if name in sys.modules]}))
+"""
+
+# Process start to loaded subcommand, median of runs, against a bare interpreter
+def benchColdStart(runs):
+    print(f"Cold start (median of {runs} fresh processes)")
+    here = os.path.dirname(os.path.abspath(__file__))
+    baseline = []
+    for _ in range(runs):
+        started = time.perf_counter()
+        subprocess.run([sys.executable, "-c", "pass"], check=True)
+        baseline.append(time.perf_counter() - started)
+    print(f"  {'python':<10} {statistics.median(baseline) * 1000:>8.1f} ms")
+    for command in ("dump", "bootstrap", "check", "eager"):
+        totals = []
+        imports = []
+        for _ in range(runs):
+            started = time.perf_counter()
+            probe = subprocess.run([sys.executable, "-c", coldStartProbe, command], cwd=here,
+                                   capture_output=True, text=True)
+            totals.append(time.perf_counter() - started)
+            if probe.returncode != 0:
+                print(f"  {command:<10} failed: {probe.stderr.strip().splitlines()[-1]}")
+                break
+            result = json.loads(probe.stdout.splitlines()[-1])
+            imports.append(result["imports"])
+        else:
+            print(f"  {command:<10} {statistics.median(totals) * 1000:>8.1f} ms  imports {statistics.median(imports) * 1000:>7.1f} ms  "
+                  f"loads {', '.join(result['loaded']) or 'no heavy packages'}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark newchecks.py")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[100, 1000, 10000], help="open alerts per scenario")
+    parser.add_argument("--churn", type=float, default=0.1, help="fraction of alerts cleared and raised per cycle")
+    parser.add_argument("--streams", type=int, nargs="+", default=[1, 3, 10], help="stream counts for the fan-out benchmark")
+    parser.add_argument("--page-sizes", type=int, nargs="+", default=[0, 1000], help="problem.get page sizes for the fan-out benchmark (0 = one response)")
+    parser.add_argument("--records", type=int, default=100000, help="problems for the record parsing benchmark")
+    parser.add_argument("--engines", action="store_true", help="also compare the sync and asyncio engines (needs aiohttp and asyncpg)")
+    parser.add_argument("--instances", type=int, nargs="+", help="also poll this many stand-in Zabbix servers concurrently")
+    parser.add_argument("--zabbix-latency", type=float, default=0.2, help="seconds the Zabbix stand-ins wait per problem.get")
+    parser.add_argument("--webex-latency", type=float, default=0.05, help="seconds the Webex stand-in waits per message")
+    parser.add_argument("--scenarios", type=int, nargs="*", help="full cycles against the stand-ins for these problem counts (no value: 100 10000 100000)")
+    parser.add_argument("--cycles", type=int, default=3, help="cycles per scenario, the first from empty tables")
+    parser.add_argument("--rate-limit-every", type=int, default=0, help="answer every Nth Webex request with 429 in the scenarios")
+    parser.add_argument("--retry-after", type=int, default=1, help="Retry-After seconds sent with those 429s")
+    parser.add_argument("--digest-threshold", type=int, default=10, help="messages per room and cycle above which the scenarios send a digest (0 = never)")
+    parser.add_argument("--cold-start", type=int, nargs="?", const=10, help="only measure cli.py start-up per subcommand over this many processes (default 10)")
+    parser.add_argument("--check", action="store_true", help="only run the end-to-end check (smallest --sizes, --churn, --cycles); exits 1 on a failure")
+    args = parser.parse_args()
+
+    if args.check:
+        exit(1 if checkCycles(min(args.sizes), max(1, int(min(args.sizes) * args.churn)), args.cycles) else 0)
+    if args.cold_start:
+        benchColdStart(args.cold_start)
+        exit(0)
+
+    if args.scenarios is not None:
+        benchScenarios(args.scenarios or [100, 10000, 100000], args.churn, args.cycles,
+                       args.webex_latency, args.rate_limit_every, args.retry_after, args.digest_threshold)
+        exit(0)
+
+    newchecks.digester.threshold = 0 # compare one message per alert on every path
+    benchRecords(args.records)
+    benchStreams(max(args.sizes), args.streams, args.page_sizes)
+    benchReconcile(args.sizes, args.churn)
+    if args.instances:
+        benchInstances(min(args.sizes), args.instances, args.zabbix_latency)
+    if args.engines:
+        benchEngines(min(args.sizes), args.webex_latency)
@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+# Command line entry point for cron and systemd units:
+#   cli.py check [--daemon ...]   one cycle (or the daemon), what newchecks.py runs
+#   cli.py bootstrap              schema migrations and the initial load, what zabbixpersite.py runs
+#   cli.py dump [--stream NAME]   the open problems per stream as JSON, no database needed
+# Arguments are parsed before anything heavy is imported, and each subcommand only loads the
+# modules it needs (dump never loads psycopg2 or the Webex SDK). The import time is reported
+# as the run's cold start; benchmark.py --cold-start compares the subcommands in fresh processes.
+import time
+started = time.perf_counter()
+import sys
+import argparse
+import importlib
+from settings import PollInterval, IncrementalFetch
+from streams import alertStreams
+
+# Module holding each subcommand's code
+commandModules = {"check": "newchecks", "bootstrap": "zabbixpersite", "dump": "zabbixpersite"}
+
+
+def buildParser():
+    parser = argparse.ArgumentParser(description="Zabbix to Webex alert integration")
+    commands = parser.add_subparsers(dest="command", metavar="{check,bootstrap,dump}")
+
+    check = commands.add_parser("check", help="reconcile the alert streams and send notifications (default)")
+    check.add_argument("--daemon", action="store_true", help="keep running and poll every --interval seconds")
+    check.add_argument("--interval", type=int, default=PollInterval, help="poll interval in seconds for --daemon")
+    check.add_argument("--async", dest="use_async", action="store_true", help="run on the asyncio engine (needs aiohttp and asyncpg)")
+    check.add_argument("--webhook", action="store_true", help="with --daemon, also take Zabbix webhook events (webhook.py); use a long --interval")
+    check.add_argument("--outbox-worker", action="store_true", help="only deliver queued Webex messages from the outbox")
+    check.add_argument("--incremental", action="store_true", default=IncrementalFetch, help="only download problems newer than the stored watermark")
+
+    commands.add_parser("bootstrap", help="apply schema migrations and load the open problems into empty tables")
+
+    dump = commands.add_parser("dump", help="print the open problems per stream as JSON")
+    dump.add_argument("--stream", action="append", choices=[stream.name for stream in alertStreams],
+                      help="only this stream (repeatable)")
+    return parser
+
+# Imports the subcommand's module; returns it with the seconds the import took
+def loadCommand(command):
+    loadStarted = time.perf_counter()
+    module = importlib.import_module(commandModules[command])
+    return module, time.perf_counter() - loadStarted
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else list(argv)
+    # No subcommand, or only the old newchecks.py flags: check
+    if not argv or (argv[0].startswith("-") and argv[0] not in ("-h", "--help")):
+        argv = ["check"] + argv
+    args = buildParser().parse_args(argv)
+
+    module, loadSeconds = loadCommand(args.command)
+    # dump writes JSON to stdout, so its report goes to stderr
+    report = sys.stderr if args.command == "dump" else sys.stdout
+    print(f"Cold start: {time.perf_counter() - started:.3f}s ({commandModules[args.command]} imported in {loadSeconds:.3f}s)", file=report)
+
+    if args.command == "check":
+        module.runCheck(args)
+    elif args.command == "bootstrap":
+        module.CreateNewDB()
+    elif args.command == "dump":
+        module.dumpProblems(args.stream)
+
+
+if __name__ == "__main__":
+    main()
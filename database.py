@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+# Shared Postgres access layer for newchecks.py, outbox.py and zabbixpersite.py.
+# Connections are pooled and health-checked when they are borrowed after being idle.
+# Statements run through execute() are prepared server-side once per connection
+# (PREPARE/EXECUTE) and timed per name, so the cycle log shows what each query costs.
+import io
+import time
+import threading
+import psycopg2 as p
+import psycopg2.extensions
+from psycopg2.extras import execute_values
+from psycopg2.pool import ThreadedConnectionPool, PoolError
+from settings import databaseParams, DBPreparedStatements, DBHealthCheckAfter
+from queries import numberedQuery
+import metrics
+import tracing
+
+
+# Connection that remembers which statements it has prepared and when it was last handed back
+class PreparingConnection(psycopg2.extensions.connection):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.prepared = set()
+        self.lastUsed = time.monotonic()
+
+def openConnection():
+    return p.connect(connection_factory=PreparingConnection, **databaseParams)
+
+# Closed connections fail at once; idle ones get a SELECT 1 before they are trusted again
+def healthy(conn, idleAfter=DBHealthCheckAfter):
+    if conn is None or conn.closed:
+        return False
+    if time.monotonic() - getattr(conn, "lastUsed", 0) < idleAfter:
+        return True
+    try:
+        cur = conn.cursor()
+        cur.execute("SELECT 1")
+        cur.close()
+        conn.rollback()
+    except p.Error:
+        return False
+    conn.lastUsed = time.monotonic()
+    return True
+
+
+#########################################POOL##################################################
+class DatabasePool:
+    def __init__(self, maxconn, minconn=1):
+        self.maxconn = maxconn
+        self.pool = ThreadedConnectionPool(minconn, maxconn, connection_factory=PreparingConnection, **databaseParams)
+
+    # Broken connections are dropped from the pool and replaced by fresh ones
+    def getconn(self):
+        for attempt in range(self.maxconn + 1):
+            conn = self.pool.getconn()
+            if healthy(conn):
+                return conn
+            print("Dropping broken pooled DB connection")
+            self.pool.putconn(conn, close=True)
+        raise PoolError("no healthy connection available")
+
+    def putconn(self, conn):
+        if not conn.closed and conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+            conn.rollback()
+        conn.lastUsed = time.monotonic()
+        self.pool.putconn(conn, close=bool(conn.closed))
+
+    def closeall(self):
+        self.pool.closeall()
+
+
+#########################################STATEMENTS##################################################
+# Per-name latency: {name: [calls, total seconds, max seconds]}
+queryStats = {}
+statsLock = threading.Lock()
+
+def recordQuery(name, elapsed):
+    metrics.dbQuerySeconds.observe(elapsed, query=name)
+    tracing.recordCall("db", name, elapsed)
+    with statsLock:
+        stats = queryStats.setdefault(name, [0, 0.0, 0.0])
+        stats[0] += 1
+        stats[1] += elapsed
+        stats[2] = max(stats[2], elapsed)
+
+def resetQueryStats():
+    with statsLock:
+        queryStats.clear()
+
+def queryStatsSummary():
+    with statsLock:
+        parts = [f"{name} {calls}x avg {total / calls * 1000:.2f} ms max {worst * 1000:.2f} ms"
+                 for name, (calls, total, worst) in sorted(queryStats.items())]
+    return "DB: " + ", ".join(parts)
+
+# Runs query under name. Prepared on first use per connection unless prepare is False
+# (multi-statement and DDL strings cannot be prepared); PREPARE time is recorded as "prepare".
+def execute(cur, name, query, params=None, prepare=True):
+    conn = cur.connection
+    if not (prepare and DBPreparedStatements and hasattr(conn, "prepared")):
+        started = time.perf_counter()
+        cur.execute(query, params)
+        recordQuery(name, time.perf_counter() - started)
+        return
+
+    if name not in conn.prepared:
+        started = time.perf_counter()
+        cur.execute(f"PREPARE {name} AS {numberedQuery(query)}")
+        conn.prepared.add(name)
+        recordQuery("prepare", time.perf_counter() - started)
+
+    started = time.perf_counter()
+    if params:
+        cur.execute(f"EXECUTE {name} ({', '.join(['%s'] * len(params))})", params)
+    else:
+        cur.execute(f"EXECUTE {name}")
+    recordQuery(name, time.perf_counter() - started)
+
+# Multi-row VALUES inserts (one statement per page, so they are timed but not prepared)
+def executeValues(cur, name, query, rows, page_size=100):
+    started = time.perf_counter()
+    execute_values(cur, query, rows, page_size=page_size)
+    recordQuery(name, time.perf_counter() - started)
+
+# COPY ... FROM STDIN in text format, for bulk loads
+def copyValue(value):
+    if value is None:
+        return "\\N"
+    return str(value).replace("\\", "\\\\").replace("\t", "\\t").replace("\n", "\\n").replace("\r", "\\r")
+
+def copyRows(cur, name, table, columns, rows):
+    data = io.StringIO()
+    for row in rows:
+        data.write("\t".join(copyValue(value) for value in row) + "\n")
+    data.seek(0)
+    started = time.perf_counter()
+    cur.copy_expert(f"COPY {table} ({columns}) FROM STDIN", data)
+    recordQuery(name, time.perf_counter() - started)
@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+# Flap suppression for the reconcilers, webhook.py and the asyncio engine (Flap_Threshold).
+# Zabbix opens a new eventid every time a trigger fires again, so flapping is tracked per
+# stream, site, host and problem name in alertflaps (site '' for streams without one). Alerts
+# whose host tag is missing carry the stream's placeholder hostname and are never tracked, as
+# they are different hosts that only share the placeholder. Every new/cleared alert counts as one state
+# change within Flap_Window; the change that reaches the threshold sends one "flapping"
+# notice instead of its own message, and while an entity is flapping its add/resolve
+# messages are dropped (the alert rows are still kept up to date). After Flap_Hold_Down
+# seconds without a change it is released with one notice carrying its current state.
+from streams import AlertRow
+from database import execute
+
+## Queries - FLAPPING
+flapRecord = """INSERT INTO alertflaps AS f (stream, site, hostname, name, transitions, window_start, last_change)
+    SELECT %s, c.site, c.hostname, c.name, c.transitions, now(), now()
+    FROM unnest(%s::varchar[], %s::varchar[], %s::varchar[], %s::int[]) AS c (site, hostname, name, transitions)
+    ON CONFLICT (stream, site, hostname, name) DO UPDATE SET
+        transitions = CASE WHEN f.window_start < now() - make_interval(secs => %s)
+            THEN EXCLUDED.transitions ELSE f.transitions + EXCLUDED.transitions END,
+        window_start = CASE WHEN f.window_start < now() - make_interval(secs => %s)
+            THEN now() ELSE f.window_start END,
+        last_change = now()
+    RETURNING site, hostname, name, transitions, flapping;"""
+flapStart = """UPDATE alertflaps SET flapping = true
+    WHERE stream = %s AND (site, hostname, name) IN (SELECT * FROM unnest(%s::varchar[], %s::varchar[], %s::varchar[]));"""
+flapExpire = """DELETE FROM alertflaps
+    WHERE stream = %s AND NOT flapping AND last_change < now() - make_interval(secs => %s);"""
+
+# Entities released after the hold-down, with whether the stream still has an open alert for them
+def flapSettle(stream):
+    site = " AND a.site = f.site" if stream.withSite else ""
+    return f"""UPDATE alertflaps f SET flapping = false, transitions = 0, window_start = now()
+    WHERE f.stream = %s AND f.flapping AND f.last_change < now() - make_interval(secs => %s)
+    RETURNING f.hostname, f.name, NULLIF(f.site, ''),
+        EXISTS (SELECT 1 FROM {stream.table} a WHERE a.hostname = f.hostname AND a.name = f.name{site});"""
+
+## Messages - FLAPPING
+flapNotice = "**Flapping:** {} on {} changed state {} times within {} min. New/resolved messages are paused until it has been stable for {} min."
+stableNotice = "**No longer flapping:** {} on {} is {} (stable for {} min)."
+
+
+# The flap entity of an alert: (site, hostname, name)
+def flapKey(row):
+    return (row.site or "", row.hostname, row.name)
+
+# Room and digest label for an entity come from the stream's own routing
+def flapMessage(stream, kind, row, text):
+    room_id, message, label = stream.route("new", row)
+    return (room_id, {"markdown": text}, kind, label, row.hostname, row.name)
+
+# Every change announced, for Flap_Threshold 0
+def routeChanges(stream, changes):
+    outgoing = []
+    for kind, row in changes:
+        room_id, message, label = stream.route(kind, row)
+        outgoing.append((room_id, message, kind, label, row.hostname, row.name))
+    return outgoing
+
+# Changes per tracked entity {(site, hostname, name): count}, the flapRecord parameters
+def flapCounts(stream, changes):
+    counts = {}
+    for kind, row in changes:
+        if row.hostname != stream.hostDefault:
+            key = flapKey(row)
+            counts[key] = counts.get(key, 0) + 1
+    return counts
+
+# With the recorded state {key: (count, flapping)}: the outbox entries still announced, and the
+# entities that start flapping now {key: their notice}, which the caller marks with flapStart
+def flapDecisions(stream, changes, state, threshold, window, holdDown):
+    outgoing = []
+    started = {}
+    for kind, row in changes:
+        key = flapKey(row)
+        count, flapping = state.get(key, (0, False))
+        if flapping:
+            continue
+        if count >= threshold:
+            if key not in started:
+                started[key] = flapMessage(stream, "flapping", row, flapNotice.format(
+                    row.name, row.hostname, count, window // 60, holdDown // 60))
+            continue
+        room_id, message, label = stream.route(kind, row)
+        outgoing.append((room_id, message, kind, label, row.hostname, row.name))
+    return outgoing, started
+
+# The notices of the entities flapSettle released: [(hostname, name, site, still open)]
+def stableMessages(stream, settled, holdDown):
+    outgoing = []
+    for hostname, name, site, isOpen in settled:
+        row = AlertRow(None, name, None, site, hostname)
+        outgoing.append(flapMessage(stream, "stable", row, stableNotice.format(
+            name, hostname, "still open" if isOpen else "resolved", holdDown // 60)))
+    return outgoing
+
+# changes: [(kind, AlertRow)] of one stream inside its transaction. Returns the outbox entries
+# (room, message, kind, label, hostname, event name) for the changes that are still announced.
+# threshold is the number of changes within window (seconds) that makes an entity flap, 0 disables.
+def filterFlapping(cur, stream, changes, threshold, window, holdDown):
+    if not threshold:
+        return routeChanges(stream, changes)
+    if not changes:
+        return []
+
+    counts = flapCounts(stream, changes)
+    state = {}
+    if counts:
+        sites, hostnames, names = zip(*counts)
+        execute(cur, "flap_record", flapRecord, (stream.name, list(sites), list(hostnames), list(names), list(counts.values()), window, window))
+        state = {(site, hostname, name): (count, flapping) for site, hostname, name, count, flapping in cur.fetchall()}
+
+    outgoing, started = flapDecisions(stream, changes, state, threshold, window, holdDown)
+    if started:
+        sites, hostnames, names = zip(*started)
+        execute(cur, "flap_start", flapStart, (stream.name, list(sites), list(hostnames), list(names)))
+        outgoing.extend(started.values())
+    return outgoing
+
+# Once per stream and cycle: releases quiet flapping entities and forgets stale counters
+def settleFlapping(cur, stream, threshold, window, holdDown):
+    if not threshold:
+        return []
+    execute(cur, f"flap_settle_{stream.name}", flapSettle(stream), (stream.name, holdDown))
+    outgoing = stableMessages(stream, cur.fetchall(), holdDown)
+    execute(cur, "flap_expire", flapExpire, (stream.name, window))
+    return outgoing
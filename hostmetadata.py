@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+# Zabbix host metadata for the stream tags, cached per instance (Host_Metadata_TTL).
+# A problem only names its trigger (objectid); trigger.get maps that to the host and host.get
+# returns the host's tags plus its technical and visible name. Problems missing one of the
+# stream tags (site, visname, hostname) get it from their host instead of falling back to
+# UNKNOWN, and with Zabbix_Problem_Tags=false the problem fetch drops selectTags altogether,
+# every stream tag then comes from here. Both lookups are batched per page for the misses
+# only; entries expire after the TTL and the least recently used go first above the size bound.
+# Hits, misses and evictions are counted per instance and cache in metrics, the lookups are timed
+# like the problem fetch (zabbixRequestSeconds, slow cycle trace).
+import time
+from collections import OrderedDict
+import metrics
+import tracing
+
+# Host fields standing in for a tag the host does not carry either
+hostFields = {"hostname": "host", "visname": "name"}
+
+
+class TTLCache:
+    def __init__(self, ttl, maxSize, **labels):
+        self.ttl = ttl
+        self.maxSize = maxSize
+        self.labels = labels # metric labels: instance, cache
+        self.entries = OrderedDict() # key -> (expires, value)
+        self.evicted = 0
+
+    # None when missing or expired
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        if entry[0] < time.monotonic():
+            del self.entries[key]
+            return None
+        self.entries.move_to_end(key)
+        return entry[1]
+
+    def put(self, key, value):
+        self.entries[key] = (time.monotonic() + self.ttl, value)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.maxSize:
+            self.entries.popitem(last=False)
+            self.evicted += 1
+            metrics.hostMetadataEvictions.inc(**self.labels)
+
+
+class HostMetadata:
+    def __init__(self, instanceName, ttl, maxHosts, tagNames):
+        self.instanceName = instanceName
+        self.tagNames = tuple(tagNames)
+        self.triggers = TTLCache(ttl, maxHosts * 4, instance=instanceName, cache="trigger") # triggerid -> hostid
+        self.hosts = TTLCache(ttl, maxHosts, instance=instanceName, cache="host") # hostid -> {tag: value}
+        self.api = None # set by the engine on every (re)login
+        self.resetStats()
+
+    def resetStats(self):
+        self.triggers.evicted = 0
+        self.hosts.evicted = 0
+        self.stats = {"hits": 0, "misses": 0, "requests": 0, "seconds": 0.0}
+
+    # In place: every problem ends up with the stream tags its host provides
+    def fill(self, problems):
+        missing = []
+        for element in problems:
+            present = {tag["tag"] for tag in element.get("tags", ())}
+            if not all(name in present for name in self.tagNames):
+                missing.append((element, present))
+        if not missing:
+            return problems
+
+        hostids = self.resolveTriggers({element["objectid"] for element, present in missing})
+        hosts = self.resolveHosts(set(hostids.values()))
+        for element, present in missing:
+            host = hosts.get(hostids.get(element["objectid"]))
+            if host is None:
+                continue
+            tags = element.setdefault("tags", [])
+            for name, value in host.items():
+                if name not in present:
+                    tags.append({"tag": name, "value": value})
+        return problems
+
+    def resolveTriggers(self, triggerids):
+        found, lookup = self.cached(self.triggers, triggerids)
+        if lookup:
+            for trigger in self.request("trigger.get", self.api.trigger.get, {
+                    "output": ["triggerid"], "triggerids": lookup, "selectHosts": ["hostid"]}):
+                if trigger["hosts"]:
+                    found[trigger["triggerid"]] = trigger["hosts"][0]["hostid"]
+                    self.triggers.put(trigger["triggerid"], trigger["hosts"][0]["hostid"])
+        return found
+
+    def resolveHosts(self, hostids):
+        found, lookup = self.cached(self.hosts, hostids)
+        if lookup:
+            for host in self.request("host.get", self.api.host.get, {
+                    "output": ["hostid", "host", "name"], "hostids": lookup, "selectTags": "extend"}):
+                values = {}
+                for name in self.tagNames:
+                    if name in hostFields:
+                        values[name] = host[hostFields[name]]
+                for tag in host.get("tags", ()):
+                    if tag["tag"] in self.tagNames:
+                        values[tag["tag"]] = tag["value"]
+                found[host["hostid"]] = values
+                self.hosts.put(host["hostid"], values)
+        return found
+
+    def cached(self, cache, keys):
+        found = {}
+        lookup = []
+        for key in keys:
+            value = cache.get(key)
+            if value is None:
+                lookup.append(key)
+            else:
+                found[key] = value
+        self.stats["hits"] += len(found)
+        self.stats["misses"] += len(lookup)
+        metrics.hostMetadataLookups.inc(len(found), result="hit", **cache.labels)
+        metrics.hostMetadataLookups.inc(len(lookup), result="miss", **cache.labels)
+        return found, lookup
+
+    # Timed and counted like newchecks.problemGet()
+    def request(self, name, method, params):
+        started = time.perf_counter()
+        result = method(params)
+        elapsed = time.perf_counter() - started
+        self.stats["requests"] += 1
+        self.stats["seconds"] += elapsed
+        metrics.zabbixRequestSeconds.observe(elapsed, instance=self.instanceName, request=name)
+        metrics.zabbixRecords.inc(len(result), instance=self.instanceName, request=name)
+        tracing.recordCall("zabbix", name, elapsed, instance=self.instanceName, records=len(result))
+        return result
+
+    def summary(self):
+        stats = self.stats
+        lookups = stats["hits"] + stats["misses"]
+        rate = stats["hits"] / lookups * 100 if lookups else 100.0
+        return (f"{len(self.hosts.entries)} hosts, {rate:.1f}% hit rate, {stats['misses']} misses, "
+                f"{self.hosts.evicted + self.triggers.evicted} evicted, {stats['requests']} requests in {stats['seconds']:.2f}s")
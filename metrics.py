@@ -0,0 +1,191 @@
+#!/usr/bin/env python3
+# Prometheus metrics for newchecks.py, in the text exposition format.
+# Every stage records here: Zabbix requests, tag parsing, DB statements, stream reconciles,
+# Webex sends and the outcome of each cycle. The daemon serves them on /metrics
+# (Metrics_Port); one-shot runs write them to Metrics_Textfile for the node exporter's
+# textfile collector. Values accumulate for the life of the process like Prometheus expects.
+import os
+import time
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from streams import ADMINRoomID
+
+# Seconds; wide enough for a single prepared statement up to a slow full fetch
+defaultBuckets = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+registry = []
+registryLock = threading.Lock()
+
+def escapeLabel(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+def labelText(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{escapeLabel(value)}"' for name, value in pairs) + "}"
+
+def formatValue(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    kind = "untyped"
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.values = {}
+        self.lock = threading.Lock()
+        with registryLock:
+            registry.append(self)
+
+    def key(self, labels):
+        return tuple(str(labels.get(name, "")) for name in self.labels)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        with self.lock:
+            for key, value in sorted(self.values.items()):
+                lines.append(f"{self.name}{labelText(self.labels, key)} {formatValue(value)}")
+        return lines
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def set(self, value, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = value
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=defaultBuckets):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+
+    # values[key] = [count per bucket..., count, sum]
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        with self.lock:
+            entry = self.values.get(key)
+            if entry is None:
+                entry = self.values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    entry[index] += 1
+            entry[-2] += 1
+            entry[-1] += value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        with self.lock:
+            for key, entry in sorted(self.values.items()):
+                for index, bound in enumerate(self.buckets):
+                    lines.append(f"{self.name}_bucket{labelText(self.labels, key, [('le', formatValue(float(bound)))])} {entry[index]}")
+                lines.append(f"{self.name}_bucket{labelText(self.labels, key, [('le', '+Inf')])} {entry[-2]}")
+                lines.append(f"{self.name}_count{labelText(self.labels, key)} {entry[-2]}")
+                lines.append(f"{self.name}_sum{labelText(self.labels, key)} {formatValue(entry[-1])}")
+        return lines
+
+    # Context manager timing a block into the histogram
+    def time(self, **labels):
+        return Timer(self, labels)
+
+class Timer:
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.started, **self.labels)
+
+
+#########################################METRICS##################################################
+zabbixRequestSeconds = Histogram("zabbixwebex_zabbix_request_seconds", "Zabbix API request latency", ("instance", "request"))
+zabbixRecords = Counter("zabbixwebex_zabbix_records_total", "Records returned by the Zabbix API", ("instance", "request"))
+parseSeconds = Histogram("zabbixwebex_parse_seconds", "Tag parsing time per page and stream", ("stream",))
+dbQuerySeconds = Histogram("zabbixwebex_db_query_seconds", "Database statement latency by statement name", ("query",))
+reconcileSeconds = Histogram("zabbixwebex_reconcile_seconds", "Stream reconcile transaction time, from snapshot to commit", ("stream",))
+reconcileFailures = Counter("zabbixwebex_reconcile_failures_total", "Stream reconciles that were rolled back", ("stream",))
+cycleSeconds = Histogram("zabbixwebex_cycle_seconds", "Duration of a full fetch and reconcile cycle")
+cycleFailures = Counter("zabbixwebex_cycle_failures_total", "Cycles that ended with an error")
+alertChanges = Counter("zabbixwebex_alerts_total", "New and cleared alerts", ("stream", "site", "kind"))
+adminRouted = Counter("zabbixwebex_admin_routed_total", "Notifications routed to the ADMIN room for missing tags", ("stream", "site", "kind"))
+notificationsQueued = Counter("zabbixwebex_notifications_queued_total", "Notifications written to the outbox", ("stream", "kind"))
+openAlerts = Gauge("zabbixwebex_open_alerts", "Open alerts per alert table", ("stream", "table"))
+webexSendSeconds = Histogram("zabbixwebex_webex_send_seconds", "Webex messages.create latency")
+webexMessages = Counter("zabbixwebex_webex_messages_total", "Webex messages by result", ("result",))
+outboxRows = Counter("zabbixwebex_outbox_rows_total", "Outbox rows by delivery result", ("result",))
+hostMetadataLookups = Counter("zabbixwebex_host_metadata_lookups_total", "Host metadata cache lookups by result", ("instance", "cache", "result"))
+hostMetadataEvictions = Counter("zabbixwebex_host_metadata_evictions_total", "Host metadata cache entries evicted above the size bound", ("instance", "cache"))
+lastCycle = Gauge("zabbixwebex_last_cycle_timestamp_seconds", "Unix time the last cycle finished")
+
+# A stream's committed alert changes [(kind, AlertRow)] and outbox entries. Outbox entries carry
+# no site; it comes from the change they were made for, or the digest label (the site) for
+# flap notices of the streams that route to ADMIN.
+def recordChanges(streamName, changes, outgoing):
+    sites = {}
+    for kind, row in changes:
+        alertChanges.inc(stream=streamName, site=row.site or "", kind=kind)
+        sites[(row.hostname, row.name)] = row.site or ""
+    for room_id, message, kind, label, hostname, event_name in outgoing:
+        notificationsQueued.inc(stream=streamName, kind=kind)
+        if room_id == ADMINRoomID:
+            adminRouted.inc(stream=streamName, site=sites.get((hostname, event_name), label or ""), kind=kind)
+
+
+def render():
+    with registryLock:
+        metrics = list(registry)
+    lines = []
+    for metric in metrics:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+# Written next to the target and renamed, so the collector never reads half a file
+def writeTextfile(path):
+    temporary = f"{path}.{os.getpid()}.tmp"
+    with open(temporary, "w") as textfile:
+        textfile.write(render())
+    os.replace(temporary, path)
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_response(404)
+            self.end_headers()
+            return
+        data = render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+def startMetricsServer(host, port):
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    print(f"Serving Prometheus metrics on {host}:{port}/metrics")
+    return server
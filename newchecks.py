@@ -1,437 +1,853 @@
 #!/usr/bin/env python3
 import psycopg2 as p
-from webexteamssdk import WebexTeamsAPI
-from zabbix_utils import ZabbixAPI
-import os
-from dotenv import load_dotenv
-load_dotenv()
-
-# Getting environmental variables
-# Tokens
-tokenWebex = os.getenv("Webex_Api_Token")
-ZabbixToken = os.getenv("Zabbix_API_Token")
-# API requirements
-ZabbixURL= os.getenv("Zabbix_URL")
-WebexRoomID = os.getenv("Webex_Room_Id") # Fallback for known but unmapped sites
-RTPRoomID = os.getenv("RTP_Room_Id")
-SJCRoomID = os.getenv("SJC_Room_Id")
-LONRoomID = os.getenv("LON_Room_Id")
-SNGRoomID = os.getenv("SNG_Room_Id")
-SYDRoomID = os.getenv("SYD_Room_Id")
-IDEVRoomID = os.getenv("IDEV_Room_Id")
-CPOCRoomID = os.getenv("CPOC_Room_Id")
-ADMINRoomID = os.getenv("ADMIN_Room_Id") # Room for alerts with missing data
-
-# --- Dashboard URLs per Site ---
-ZabbixURL_RTP = os.getenv("ZabbixURL_RTP")
-ZabbixURL_SJC = os.getenv("ZabbixURL_SJC")
-ZabbixURL_LON = os.getenv("ZabbixURL_LON")
-ZabbixURL_SNG = os.getenv("ZabbixURL_SNG")
-ZabbixURL_SYD = os.getenv("ZabbixURL_SYD")
-ZabbixURL_IDEV = os.getenv("ZabbixURL_IDEV")
-ZabbixURL_CPOC = os.getenv("ZabbixURL_CPOC")
-ZabbixURL_ADMIN = os.getenv("ZabbixURL_ADMIN") 
-
-# Database information
-DatabaseName = os.getenv("Database_Name")
-DatabaseUsername = os.getenv("Database_Username")
-DatabasePassword = os.getenv("Database_Password")
-DatabaseIp = os.getenv("Database_Ip")
-DatabasePort = os.getenv("Database_Port")
-
-siteRoomMap = {
-    "SJC": SJCRoomID,
-    "RTP": RTPRoomID,
-    "LON": LONRoomID,
-    "SNG": SNGRoomID,
-    "SYD": SYDRoomID,
-    "IDEV": IDEVRoomID,
-    "CPOC": CPOCRoomID
-}
-
-# --- New Mapping for Dashboards ---
-siteDashboardMap = {
-    "SJC": ZabbixURL_SJC,
-    "RTP": ZabbixURL_RTP,
-    "LON": ZabbixURL_LON,
-    "SNG": ZabbixURL_SNG,
-    "SYD": ZabbixURL_SYD,
-    "IDEV": ZabbixURL_IDEV,
-    "CPOC": ZabbixURL_CPOC,
-}
-
-## Queries - HOSTS
-hostAlertTobeAdded = "INSERT INTO hostalerts (eventid, name, clock, hostname) VALUES (%s, %s, %s, %s);"
-hostAlertToBeRemoved = "DELETE FROM hostalerts WHERE eventid = (%s)"
-hostAlertInformationById = "SELECT * FROM hostalerts WHERE eventid=(%s)"
-hostClearMessage = "VMWare host: {} is up **resolved** "
-hostAddMessage = "New triggered alert for host: {} description: {}"
-
-## Queries - SITES
-siteAlertTobeAdded = "INSERT INTO sitealerts (eventid, name, clock, site, hostname) VALUES (%s, %s, %s, %s, %s);"
-siteAlertToBeRemoved = "DELETE FROM sitealerts WHERE eventid = (%s)"
-siteAlertInformationById = "SELECT * FROM sitealerts WHERE eventid=(%s)"
-siteClearMessage = "Site alert **resolved** in {}: {} (Host: {})"
-siteAddMessage = "New site alert in {}: {} (Host: {})"
-
-## Queries - CPOC
-cpocAlertTobeAdded = "INSERT INTO cpocalerts (eventid, name, clock, site, hostname) VALUES (%s, %s, %s, %s, %s);"
-cpocAlertToBeRemoved = "DELETE FROM cpocalerts WHERE eventid = (%s)"
-cpocAlertInformationById = "SELECT * FROM cpocalerts WHERE eventid=(%s)"
-cpocClearMessage = "CPOC alert **resolved** in {}: {} (Host: {})"
-cpocAddMessage = "New CPOC alert in {}: {} (Host: {})"
-
-# Message for alerts with 'UNKNOWN' data
-missingInfoMessage = "Site alert with missing info (sent to Admin). Site: {}, Host: {}. Alert: {}"
-
-
-# Initializing API objects
-# Webex
-apiWebex = WebexTeamsAPI(access_token=tokenWebex)
-# Zabbix
-apiZabbix = ZabbixAPI(url=ZabbixURL)
-apiZabbix.login(token=ZabbixToken)
-
-# Database connection params:
-try:
-    conn = p.connect(
-        dbname=DatabaseName,
-        user=DatabaseUsername,
-        password=DatabasePassword,
-        host=DatabaseIp,
-        port=DatabasePort
-    )
-except p.Error as e:
-    print(f"Error connecting to database: {e}")
-    exit(1)
-
-
-# Getting zabbix all severity 5 (disaster alerts) for vmware hosts
-def getHostDownIssues(): 
-    request_param = {
-                    "output" : ["name","eventid","clock"],      
-                    "severities" : 5,
-                    "selectTags": "extend"
-                     }
-    problems = apiZabbix.problem.get( request_param ) 
-    return problems
-
-# Getting zabbix all severity 5 (disaster alerts) for site (Group ID 557)
-def getSiteIssues(): 
-    request_param = {
-                    "output" : ["name","eventid","clock"],      
-                    "severities" : 5,
-                    "groupids" : [557],
-                    "selectTags": "extend"
-                     }
-    problems = apiZabbix.problem.get( request_param ) 
-    return problems
-
-# Getting zabbix all severity 5 (disaster alerts) for CPOC (Group ID 551)
-def getCPOCIssues(): 
-    request_param = {
-                    "output" : ["name","eventid","clock"],      
-                    "severities" : 5,
-                    "groupids" : [551], # <-- Group ID 551
-                    "selectTags": "extend"
-                     }
-    problems = apiZabbix.problem.get( request_param ) 
-    return problems
-
-#########################################HOSTS##################################################
-def getCurrentProblems():
-    data = []
-    for element in getHostDownIssues():
-        if  element["name"] == "VMware: Hypervisor is down" :
-            internalList = []
-            internalList.append(element["eventid"])
-            internalList.append(element["name"])
-            internalList.append(element["clock"])
-            for tag in element["tags"]:
-                if tag["tag"] == "hostname":
-                    internalList.append(tag["value"])
-            if len(internalList) == 4:
-                data.append(internalList)
-        else:
+from alertdigest import AlertDigester
+from outbox import queueNotifications, deliverOutbox, cleanupOutbox, outboxPending
+from streams import AlertRow, alertStreams, streamGroups, streamTags, partitionProblems, highestEvent
+from zabbixinstances import buildInstances, eventidCeilings
+from sharding import claimShards, releaseShards, lockStream
+from alertcache import AlertCache, bumpVersion
+from hostmetadata import HostMetadata
+from flapping import filterFlapping, settleFlapping
+import metrics
+import tracing
+from schema import ensureSchema
+from database import DatabasePool, openConnection, healthy, execute, executeValues, resetQueryStats, queryStatsSummary
+import json
+import time
+import queue
+import signal
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
+from psycopg2.pool import PoolError
+from settings import (tokenWebex, WebexApiURL, BatchPageSize, ZabbixInstances, ZabbixPageSize, HostMetadataTTL,
+                      HostMetadataSize, ProblemTags, IncrementalFetch, ParallelStreams, CycleDeadline, DBPoolSize,
+                      AlertCacheRefresh, ShardStreams, ShardNode, ShardLease, MetricsHost, MetricsPort, MetricsTextfile,
+                      WebexMaxWorkers, WebexRoomConcurrency, WebexMaxRetries, WebexFlushTimeout, DigestThreshold,
+                      DigestMaxHosts, FlapThreshold, FlapWindow, FlapHoldDown, OutboxBatchSize, OutboxLease,
+                      OutboxMaxAttempts, OutboxBackoffBase, OutboxBackoffMax, OutboxPollInterval, OutboxRetentionDays)
+from queries import (snapshotTables, snapshotRowsInsert, snapshotOpenInsert, snapshotOpenFromRows,
+                     watermarkSelect, watermarkUpsert, disasterParams, eventIdParams)
+
+
+# Alert storm digests
+digester = AlertDigester(DigestThreshold, DigestMaxHosts)
+
+# API objects and database connection, created by connectServices()
+apiWebex = None
+dispatcher = None
+zabbixInstances = []
+conn = None
+dbPool = None
+# Open alert ids per stream, kept across cycles by runDaemon()
+alertCache = None
+
+# Initializing API objects. The SDKs are imported here so a run that never needs them
+# (nothing to send, bootstrap, dump) does not pay for loading them.
+def connectWebex():
+    global apiWebex, dispatcher
+    from webexteamssdk import WebexTeamsAPI
+    from webexdispatcher import WebexDispatcher
+    # Rate limits are handled by the dispatcher (Retry-After), not by sleeping inside the SDK
+    apiWebex = WebexTeamsAPI(access_token=tokenWebex, base_url=WebexApiURL, wait_on_rate_limit=False)
+    dispatcher = WebexDispatcher(apiWebex, WebexMaxWorkers, WebexRoomConcurrency, WebexMaxRetries)
+
+# Host metadata per instance name, kept across reconnects
+hostMetadata = {}
+
+# One session per configured Zabbix instance (settings.ZabbixInstances)
+def connectZabbix():
+    global zabbixInstances
+    from zabbix_utils import ZabbixAPI
+    instances = buildInstances(ZabbixInstances)
+    for instance in instances:
+        instance.api = ZabbixAPI(url=instance.url)
+        instance.api.login(token=instance.token)
+        if HostMetadataTTL:
+            instance.metadata = hostMetadata.setdefault(instance.name, HostMetadata(instance.name, HostMetadataTTL, HostMetadataSize, streamTags()))
+            instance.metadata.api = instance.api
+    zabbixInstances = instances
+
+# Database connection
+def openDatabase():
+    return openConnection()
+
+def connectDatabase():
+    global conn
+    conn = openDatabase()
+
+# Pool the streams borrow their connections from, one per stream during a cycle
+def connectPool():
+    global dbPool
+    dbPool = DatabasePool(DBPoolSize)
+
+# (Re)creating whatever is missing or broken, so a daemon keeps its sessions across cycles
+def connectServices():
+    if dispatcher is None:
+        connectWebex()
+    if not zabbixInstances:
+        connectZabbix()
+    if not healthy(conn):
+        if conn is not None:
+            conn.close()
+        connectDatabase()
+    if dbPool is None:
+        connectPool()
+
+def closeServices(keepWebex=False):
+    global apiWebex, dispatcher, zabbixInstances, zabbixExecutor, conn, dbPool
+    if dispatcher is not None and not keepWebex:
+        dispatcher.shutdown(WebexFlushTimeout)
+        dispatcher = None
+        apiWebex = None
+    for instance in zabbixInstances:
+        try:
+            instance.api.logout()
+        except Exception:
             pass
-    return data
-
-#########################################SITE##################################################
-def getSiteProblems():
-    data = []
-    for element in getSiteIssues(): 
-        tags_dict = {tag['tag']: tag['value'] for tag in element.get('tags', [])}
-        
-        # if it doesn't find the tag, assign "UNKNOWN"
-        site = tags_dict.get("site", "UNKNOWN")
-        visname = tags_dict.get("visname", "UNKNOWN") 
-
-        internalList = [
-            element["eventid"],
-            element["name"],
-            element["clock"],
-            site,
-            visname 
-        ]
-        data.append(internalList)
-    return data
-
-#########################################CPOC##################################################
-def getCPOCProblems(): 
-    data = []
-    for element in getCPOCIssues(): 
-        tags_dict = {tag['tag']: tag['value'] for tag in element.get('tags', [])}
-        
-        
-        site = "CPOC" 
-        
-        
-        visname = tags_dict.get("visname", "UNKNOWN_HOST") 
-
-        internalList = [
-            element["eventid"],
-            element["name"],
-            element["clock"],
-            site,
-            visname 
-        ]
-        data.append(internalList)
-    return data
-
-# Connecting to db to check host alerts
-def getDBexistingProblems():
-    dbdata = []
-    cur = None
+    zabbixInstances = []
+    if zabbixExecutor is not None:
+        zabbixExecutor.shutdown(wait=False)
+        zabbixExecutor = None
+    if conn is not None:
+        try:
+            conn.close()
+        except p.Error:
+            pass
+        conn = None
+    if dbPool is not None:
+        stopStreamWorkers()
+        dbPool.closeall()
+        dbPool = None
+
+# Per-cycle Zabbix fetch counter (records, approximate payload bytes), shared by the instance threads.
+# Measuring a page means serializing it again, so the bytes are only counted while a slow cycle trace
+# is collecting or with fetchSizes set (benchmark.py).
+fetchStats = {"requests": 0, "bytes": 0, "records": 0}
+fetchLock = threading.Lock()
+fetchSizes = False
+
+def resetFetchStats():
+    for key in fetchStats:
+        fetchStats[key] = 0
+
+# Returns the payload size, None when it is not measured
+def recordFetch(result):
+    size = len(json.dumps(result)) if fetchSizes or tracing.active is not None else None
+    with fetchLock:
+        fetchStats["requests"] += 1
+        fetchStats["bytes"] += size or 0
+        fetchStats["records"] += len(result)
+    return size
+
+# Every Zabbix problem.get goes through here: timed and counted per instance and request kind
+def problemGet(instance, kind, request):
+    started = time.perf_counter()
+    result = instance.api.problem.get( request )
+    elapsed = time.perf_counter() - started
+    metrics.zabbixRequestSeconds.observe(elapsed, instance=instance.name, request=kind)
+    metrics.zabbixRecords.inc(len(result), instance=instance.name, request=kind)
+    size = recordFetch(result)
+    tracing.recordCall("zabbix", kind, elapsed, instance=instance.name, records=len(result), bytes=size)
+    return result
+
+def printFetchStats():
+    sizes = f", {fetchStats['bytes']} bytes" if fetchStats["bytes"] else ""
+    print(f"Zabbix fetch: {fetchStats['requests']} requests, {fetchStats['records']} records{sizes}")
+    for instance in zabbixInstances:
+        if instance.metadata is not None:
+            print(f"Host metadata ({instance.name}): {instance.metadata.summary()}")
+            instance.metadata.resetStats()
+
+# Problem request of a cycle: tags from problem.get, from the host metadata, or both
+def cycleParams(eventidFrom=None, eventidTill=None):
+    return disasterParams(eventidFrom, tags=ProblemTags or not HostMetadataTTL, objectid=bool(HostMetadataTTL), eventidTill=eventidTill)
+
+# Paging through an instance's severity 5 problems (with tags) in eventid order, so only one page
+# is held in memory at a time; ZabbixPageSize 0 asks for everything in one response.
+# Pages come out with instance-qualified eventids.
+def problemPages(instance, params):
+    eventidFrom = params.get("eventid_from")
+    while True:
+        request = dict(params)
+        if ZabbixPageSize:
+            request.update({"sortfield": "eventid", "sortorder": "ASC", "limit": ZabbixPageSize})
+        if eventidFrom is not None:
+            request["eventid_from"] = str(eventidFrom)
+        page = problemGet(instance, "problems", request)
+        if page:
+            lastEventid = int(page[-1]["eventid"])
+            if instance.metadata is not None:
+                instance.metadata.fill(page)
+            advanceWatermark(instance, page)
+            yield instance.qualifyProblems(page)
+        if not ZabbixPageSize or len(page) < ZabbixPageSize:
+            return
+        eventidFrom = lastEventid + 1
+
+# Getting only the eventids of severity 5 problems in a host group (no tags, no names)
+def getGroupEventIds(instance, groupid):
+    problems = problemGet(instance, "group_ids", eventIdParams(instance.groupid(groupid)))
+    return instance.qualifyIds(problems)
+
+# Getting only the eventids of every open severity 5 problem, used to find resolved alerts cheaply
+def getOpenEventIds(instance):
+    problems = problemGet(instance, "open_ids", eventIdParams())
+    return instance.qualifyIds(problems)
+
+# One instance's id-only queries: in incremental mode the open id set, then one per distinct host group.
+# The open ids come first: eventids only grow, so every problem up to the highest of them that is
+# still open shows up in its group's set too. Returns the instance's own last eventid with them.
+def instanceScope(instance, incremental):
+    openIds = getOpenEventIds(instance) if incremental else None
+    groupMembers = {groupid: getGroupEventIds(instance, groupid) for groupid in streamGroups()}
+    lastEventid = max((int(eventid) for eventid in openIds), default=None) if incremental else None
+    if lastEventid is not None:
+        lastEventid -= instance.offset
+    return groupMembers, openIds, lastEventid
+
+# Zabbix instances are polled on their own threads, so a cycle waits for the slowest one, not the sum
+zabbixExecutor = None
+
+def instanceExecutor():
+    global zabbixExecutor
+    if zabbixExecutor is None:
+        zabbixExecutor = ThreadPoolExecutor(max_workers=max(1, len(zabbixInstances)), thread_name_prefix="zabbix")
+    return zabbixExecutor
+
+# The id-only queries that run before the problem pages, merged across instances. In incremental
+# mode each instance's problem request starts past its stored watermark and ends at the last
+# eventid of its open id set: a problem opened after the id queries would be missing from them
+# (inserted and cleared at once, or dropped by its group) while the watermark moved past it, so
+# it is left to the next cycle instead. Without open problems the request is empty (till < from).
+# Returns ({instance name: problem request}, {groupid: eventids}, {stream name: open ids or None}).
+def fetchCycleScope(incremental=False):
+    watermarks = loadWatermarks() if incremental else {}
+    futures = [instanceExecutor().submit(instanceScope, instance, incremental) for instance in zabbixInstances]
+    params = {}
+    groupMembers = {groupid: set() for groupid in streamGroups()}
+    openIds = set() if incremental else None
+    for instance, future in zip(zabbixInstances, futures):
+        instanceMembers, instanceOpenIds, lastEventid = future.result()
+        for groupid, members in instanceMembers.items():
+            groupMembers[groupid] |= members
+        if incremental:
+            openIds |= instanceOpenIds
+            watermark = watermarks[instance.name]
+            cycleCeilings[instance.name] = watermark if lastEventid is None else lastEventid
+            params[instance.name] = cycleParams(watermark + 1, cycleCeilings[instance.name])
+        else:
+            params[instance.name] = cycleParams()
+
+    streamOpenIds = {name: ids for name, (problems, ids) in partitionProblems([], groupMembers, openIds).items()}
+    return params, groupMembers, streamOpenIds
+
+# Every instance's pages, as they arrive, through a bounded queue (memory stays a few pages)
+def cyclePages(params):
+    pages = queue.Queue(maxsize=2 * len(zabbixInstances))
+    stopped = threading.Event()
+
+    def offer(item):
+        while not stopped.is_set():
+            try:
+                pages.put(item, timeout=1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    # Each instance ends with None, or with the exception that stopped it
+    def produce(instance):
+        try:
+            for page in problemPages(instance, params[instance.name]):
+                if not offer(page):
+                    return
+        except Exception as e:
+            offer(e)
+            return
+        offer(None)
+
+    for instance in zabbixInstances:
+        instanceExecutor().submit(produce, instance)
     try:
-        cur = conn.cursor()
-        cur.execute("SELECT eventid FROM hostalerts;")
-        dbdata = cur.fetchall()
-    except p.Error as e:
-        print(f"Error getting host problems from DB: {e}")
+        running = len(zabbixInstances)
+        while running:
+            page = pages.get()
+            if page is None:
+                running -= 1
+            elif isinstance(page, Exception):
+                raise page
+            else:
+                yield page
     finally:
-        if cur:
-            cur.close()
-    return(dbdata)
-
-# Connecting to db to check site alerts
-def getDBSiteProblems():
-    dbdata = []
+        # Unblocks producers when the consumer gave up early
+        stopped.set()
+
+#########################################WATERMARKS##################################################
+# Highest eventid seen per instance by the current fetch, stored per stream once that stream commits
+cycleWatermarks = {}
+watermarkLock = threading.Lock()
+
+# Highest own eventid per instance seen by the incremental open id query; with the pages' highest
+# (cycleWatermarks) this caps what deleteCleared may remove, rows above were pushed after the fetch
+cycleCeilings = {}
+
+def deleteCeilings():
+    highest = {}
+    for instance in zabbixInstances:
+        seen = [eventid for eventid in (cycleCeilings.get(instance.name), cycleWatermarks.get(instance.name, (None,))[0]) if eventid is not None]
+        highest[instance.name] = max(seen, default=None)
+    return eventidCeilings(zabbixInstances, highest)
+
+def advanceWatermark(instance, page):
+    eventid, clock = highestEvent(page)
+    with watermarkLock:
+        current = cycleWatermarks.get(instance.name)
+        if eventid is not None and (current is None or eventid > current[0]):
+            cycleWatermarks[instance.name] = (eventid, clock)
+
+# Lowest watermark across the streams per instance, so no stream misses a problem. 0 means full fetch.
+def loadWatermarks():
+    keys = [instance.watermarkKey(stream.name) for instance in zabbixInstances for stream in alertStreams]
     cur = None
     try:
         cur = conn.cursor()
-        cur.execute("SELECT eventid FROM sitealerts;")
-        dbdata = cur.fetchall()
+        execute(cur, "watermark_select", watermarkSelect, (keys,))
+        stored = {row[0]: int(row[1]) for row in cur.fetchall()}
+        conn.commit()
     except p.Error as e:
-        print(f"Error getting site problems from DB: {e}")
+        print(f"Error getting watermarks from DB, doing a full fetch: {e}")
+        conn.rollback()
+        stored = {}
     finally:
         if cur:
             cur.close()
-    return(dbdata)
-
-# Connecting to db to check CPOC alerts
-def getDBCPOCProblems():
-    dbdata = []
+    watermarks = {}
+    for instance in zabbixInstances:
+        streamMarks = [stored.get(instance.watermarkKey(stream.name)) for stream in alertStreams]
+        watermarks[instance.name] = 0 if None in streamMarks else min(streamMarks)
+    return watermarks
+
+# Called inside the reconciler transaction, so the watermark only moves if the alerts were stored
+def saveWatermark(cur, stream):
+    for instance in zabbixInstances:
+        if instance.name in cycleWatermarks:
+            eventid, clock = cycleWatermarks[instance.name]
+            execute(cur, "watermark_upsert", watermarkUpsert, (instance.watermarkKey(stream), eventid, clock))
+
+#########################################RECONCILIATION##################################################
+# The Zabbix side of a stream goes into temp tables, so new and cleared alerts are computed
+# by one set-based statement each instead of a SELECT/INSERT/DELETE per eventid.
+# openIds is the full open id set in incremental mode; otherwise the loaded rows are the open set.
+def beginZabbixSnapshot(cur):
+    execute(cur, "snapshot_tables", snapshotTables, prepare=False)
+
+def loadOpenIds(cur, openIds):
+    executeValues(cur, "snapshot_open", snapshotOpenInsert, [(eventid,) for eventid in openIds], page_size=BatchPageSize)
+
+def loadZabbixRows(cur, rows):
+    executeValues(cur, "snapshot_rows", snapshotRowsInsert, rows, page_size=BatchPageSize)
+
+# New alerts are inserted and cleared ones deleted, together with their outbox notifications
+# (see flapping.py), the stream's alertversions bump and (incremental mode) the stream watermark.
+# clearedIds comes from the alert cache: those rows are deleted by id, zabbix_open is not used.
+# Returns ([(kind, AlertRow)], outbox entries, new version or None if nothing changed).
+def finishStream(stream, cur, openIds=None, clearedIds=None):
+    steps = [("new", f"new_{stream.name}", stream.insertNew, None)]
+    if clearedIds is None:
+        if openIds is None:
+            execute(cur, "snapshot_open_from_rows", snapshotOpenFromRows)
+        steps.append(("cleared", f"cleared_{stream.name}", stream.deleteCleared, (deleteCeilings(),)))
+    elif clearedIds:
+        steps.append(("cleared", f"cleared_ids_{stream.name}", stream.deleteIds, (list(clearedIds),)))
+
+    changes = []
+    for kind, name, query, params in steps:
+        execute(cur, name, query, params)
+        changes.extend((kind, row) for row in map(AlertRow._make, cur.fetchall()))
+
+    if openIds is not None:
+        saveWatermark(cur, stream.name)
+
+    # Notifications go to the outbox in the same transaction as the alert rows, minus flapping ones
+    outgoing = filterFlapping(cur, stream, changes, FlapThreshold, FlapWindow, FlapHoldDown)
+    outgoing += settleFlapping(cur, stream, FlapThreshold, FlapWindow, FlapHoldDown)
+    queueNotifications(cur, outgoing)
+    version = bumpVersion(cur, stream.name) if changes else None
+    return changes, outgoing, version
+
+
+# One stream's reconcile transaction, fed page by page while the problems are still being fetched.
+# The stream's advisory lock is only taken for finishStream() and the commit, so webhook events
+# wait for those statements, not for the fetch; sharded nodes skip a stream another node is
+# reconciling instead of waiting. What the webhook did in between is left alone: pushed rows are
+# above the eventid ceiling (or missing from the cache's known ids), cleared ones are in alertcleared.
+# With the alert cache (daemon) only rows new to the stream reach zabbix_rows.
+class StreamLoad:
+    def __init__(self, stream, dbconn, openIds=None, sharded=False, pool=None):
+        self.stream = stream
+        self.dbconn = dbconn
+        self.pool = pool # the pool dbconn was borrowed from, if any
+        self.openIds = None
+        self.cur = dbconn.cursor()
+        self.rows = 0
+        self.failed = False
+        self.started = time.monotonic()
+        self.sharded = sharded
+        self.known = None
+        self.knownVersion = None
+        self.seen = None
+        self.run(beginZabbixSnapshot, self.cur)
+        if alertCache is not None:
+            self.knownVersion, self.known = self.run(alertCache.known, self.cur, stream) or (None, None)
+            self.seen = set()
+        if openIds is not None:
+            self.setOpenIds(openIds)
+
+    def fence(self, sharded):
+        if not lockStream(self.cur, self.stream.name, wait=not sharded):
+            raise RuntimeError("another node is reconciling it")
+
+    # Incremental mode: the complete open id set, the rows then only hold new problems
+    def setOpenIds(self, openIds):
+        self.openIds = openIds
+        if self.known is None:
+            self.run(loadOpenIds, self.cur, openIds)
+
+    # A failed step aborts the transaction, the stream is skipped for the rest of the cycle
+    def run(self, step, *args):
+        if self.failed:
+            return None
+        try:
+            return step(*args)
+        except Exception as e:
+            print(f"Error during reconcile of {self.stream.name} stream: {e}")
+            self.failed = True
+            self.dbconn.rollback()
+            return None
+
+    def addRows(self, rows):
+        self.rows += len(rows)
+        if self.known is not None:
+            if self.openIds is None:
+                self.seen.update(row.eventid for row in rows)
+            rows = [row for row in rows if row.eventid not in self.known]
+        self.run(loadZabbixRows, self.cur, rows)
+
+    def add(self, problems):
+        with metrics.parseSeconds.time(stream=self.stream.name):
+            rows = self.stream.prepare(problems)
+        self.addRows(rows)
+
+    def finish(self):
+        clearedIds = None
+        if self.known is not None:
+            clearedIds = self.known - (self.seen if self.openIds is None else self.openIds)
+        with tracing.span("reconcile", stream=self.stream.name, rows=self.rows):
+            self.run(self.fence, self.sharded)
+            result = self.run(finishStream, self.stream, self.cur, self.openIds, clearedIds)
+            self.run(self.dbconn.commit)
+        self.cur.close()
+        if self.failed:
+            metrics.reconcileFailures.inc(stream=self.stream.name)
+            raise RuntimeError("rolled back")
+        changes, outgoing, version = result
+        if self.known is not None and version is not None:
+            if version == self.knownVersion + 1:
+                alertCache.apply(self.stream.name, version,
+                                 [row.eventid for kind, row in changes if kind == "new"],
+                                 [row.eventid for kind, row in changes if kind == "cleared"])
+            else:
+                alertCache.invalidate(self.stream.name)
+        metrics.recordChanges(self.stream.name, changes, outgoing)
+        elapsed = time.monotonic() - self.started
+        metrics.reconcileSeconds.observe(elapsed, stream=self.stream.name)
+        return elapsed
+
+    def abort(self):
+        if not self.failed:
+            self.failed = True
+            self.dbconn.rollback()
+        self.cur.close()
+
+
+# Reconciling one stream from already prepared rows in one transaction
+def reconcileStream(stream, rows, openIds=None, dbconn=None):
+    load = StreamLoad(stream, dbconn or conn, openIds)
+    load.addRows(rows)
+    try:
+        load.finish()
+    except RuntimeError:
+        pass # already reported by StreamLoad
+
+
+# Sending whatever the reconcilers left in the outbox, digesting storms per room.
+# The Webex client is only created once there is something to send.
+def deliverPending(dbconn, stopEvent=None):
+    if dispatcher is None:
+        if not outboxPending(dbconn, OutboxMaxAttempts):
+            return
+        connectWebex()
+    delivered, failed, messages, digests = deliverOutbox(dbconn, dispatcher, digester, OutboxBatchSize, OutboxLease,
+                                                         OutboxMaxAttempts, OutboxBackoffBase, OutboxBackoffMax, WebexFlushTimeout,
+                                                         stopEvent)
+    if delivered or failed:
+        print(f"Outbox: {delivered} delivered, {failed} failed, {messages} single messages, {digests} digests")
+        print(dispatcher.summary())
+        dispatcher.resetStats()
+
+#########################################STREAM WORKERS##################################################
+# A stream still running when its next cycle starts is skipped, so it is never reconciled twice at once
+streamExecutor = None
+runningStreams = set()
+runningLock = threading.Lock()
+
+# Borrowing a pooled connection and opening the snapshot for every stream that is not still running
+# (and, when sharded, that this node owns)
+def openStreamLoads(owned=None):
+    loads = []
+    for stream in alertStreams:
+        if owned is not None and stream.name not in owned:
+            continue
+        with runningLock:
+            if stream.name in runningStreams:
+                print(f"Skipping {stream.name} stream, previous cycle is still running")
+                continue
+            runningStreams.add(stream.name)
+        pool = dbPool
+        dbconn = None
+        try:
+            dbconn = pool.getconn()
+            loads.append(StreamLoad(stream, dbconn, sharded=owned is not None, pool=pool))
+        except Exception:
+            releaseStream(stream.name, dbconn, pool)
+            closeStreamLoads(loads)
+            raise
+    return loads
+
+# The connection goes back to the pool it was borrowed from. When closeServices() closed that pool
+# meanwhile, it is closed instead; the stream is released either way, or it would be skipped for good.
+def releaseStream(name, dbconn=None, pool=None):
+    try:
+        if dbconn is not None:
+            try:
+                pool.putconn(dbconn)
+            except (PoolError, p.Error):
+                dbconn.close()
+    finally:
+        with runningLock:
+            runningStreams.discard(name)
+
+def closeStreamLoads(loads):
+    for load in loads:
+        try:
+            load.abort()
+        finally:
+            releaseStream(load.stream.name, load.dbconn, load.pool)
+
+# Reconciliation of one loaded stream; returns the seconds it took since its snapshot was opened
+def runStream(load):
+    try:
+        return load.finish()
+    finally:
+        releaseStream(load.stream.name, load.dbconn, load.pool)
+
+# Stream workers not finished yet {future: load}, so closeServices() can wait for them
+streamFutures = {}
+
+def forgetStream(future):
+    with runningLock:
+        streamFutures.pop(future, None)
+
+# Queued workers are cancelled and released here, running ones get up to CycleDeadline to return
+# their connections before the pool is closed
+def stopStreamWorkers():
+    with runningLock:
+        lateStreams = dict(streamFutures)
+    for future, load in lateStreams.items():
+        if future.cancel():
+            closeStreamLoads([load])
+    wait(lateStreams, timeout=CycleDeadline)
+
+def finishStreamsParallel(loads):
+    global streamExecutor
+    if streamExecutor is None:
+        streamExecutor = ThreadPoolExecutor(max_workers=len(alertStreams), thread_name_prefix="stream")
+
+    futures = {}
+    for load in loads:
+        future = streamExecutor.submit(runStream, load)
+        futures[future] = load.stream.name
+        with runningLock:
+            streamFutures[future] = load
+        future.add_done_callback(forgetStream)
+    done, late = wait(futures, timeout=CycleDeadline)
+    timings = {}
+    for future in done:
+        try:
+            timings[futures[future]] = f"{future.result():.2f}s"
+        except Exception as e:
+            timings[futures[future]] = f"failed ({e})"
+    for future in late:
+        timings[futures[future]] = f"still running after {CycleDeadline}s"
+    return timings
+
+def finishStreamsSequential(loads):
+    timings = {}
+    for load in loads:
+        try:
+            timings[load.stream.name] = f"{runStream(load):.2f}s"
+        except Exception as e:
+            timings[load.stream.name] = f"failed ({e})"
+    return timings
+
+# One full pass. The problem pages are partitioned, parsed and loaded into every stream's snapshot
+# as they arrive, so memory is bounded by the page size; the streams then reconcile against the DB.
+# deliver=False leaves the outbox to a separate delivery worker.
+def runCycle(deliver=True):
+    started = time.monotonic()
+    tracing.startCycle()
+    try:
+        resetFetchStats()
+        resetQueryStats()
+        cycleWatermarks.clear()
+        cycleCeilings.clear()
+
+        # Sharded: only the streams this node holds a lease on
+        owned = None
+        if ShardStreams:
+            with tracing.span("shards"):
+                owned = claimShards(conn, ShardNode, [stream.name for stream in alertStreams], ShardLease)
+            print(f"Shard {ShardNode} owns: {', '.join(sorted(owned)) or 'nothing'}")
+
+        if owned == set():
+            timings = {}
+        else:
+            timings = reconcileStreams(owned)
+        print("Stream timings: " + ", ".join(f"{name} {timing}" for name, timing in timings.items()))
+        if deliver:
+            with tracing.span("deliver"):
+                deliverPending(conn)
+        print(queryStatsSummary())
+        if alertCache is not None:
+            print(alertCache.summary())
+        with tracing.span("open_alerts"):
+            recordOpenAlerts()
+    finally:
+        traceFile = tracing.finishCycle()
+        if traceFile:
+            print(f"Slow cycle ({time.monotonic() - started:.2f}s), trace written to {traceFile}")
+    metrics.cycleSeconds.observe(time.monotonic() - started)
+    metrics.lastCycle.set(time.time())
+
+# Open alerts gauge: the cached id sets where the daemon has them, a count(*) otherwise
+def recordOpenAlerts():
     cur = None
     try:
         cur = conn.cursor()
-        cur.execute("SELECT eventid FROM cpocalerts;")
-        dbdata = cur.fetchall()
+        for stream in alertStreams:
+            size = alertCache.size(stream.name) if alertCache is not None else None
+            if size is None:
+                execute(cur, f"count_{stream.name}", f"SELECT count(*) FROM {stream.table};")
+                size = cur.fetchone()[0]
+            metrics.openAlerts.set(size, stream=stream.name, table=stream.table)
+        conn.commit()
     except p.Error as e:
-        print(f"Error getting CPOC problems from DB: {e}")
+        print(f"Error counting open alerts: {e}")
+        conn.rollback()
     finally:
         if cur:
             cur.close()
-    return(dbdata)
-
 
-def alertCheckingHosts(zabbixData, postgresData):
-    postgres_ids = {int(item[0]) for item in postgresData}
-    zabbix_ids = {int(item[0]) for item in zabbixData}
-    
-    newAlert = zabbix_ids - postgres_ids
-    clearAlert = postgres_ids - zabbix_ids
-    
-    cur = conn.cursor()
+# The loads are opened before anything is fetched from Zabbix, each stream is locked when it finishes
+def reconcileStreams(owned=None):
+    with tracing.span("open_streams"):
+        loads = openStreamLoads(owned)
     try:
-        if newAlert:
-            for element in zabbixData:
-                if int(element[0]) in newAlert:
-                    valores = (element[0], element[1], element[2], element[3])
-                    Message = hostAddMessage.format(element[3], element[1])
-                    cur.execute(hostAlertTobeAdded, valores) 
-                    apiWebex.messages.create(roomId=WebexRoomID, text=Message)
-
-        if clearAlert:
-            for id in clearAlert:
-                cur.execute(hostAlertInformationById, (id,))
-                alert_info = cur.fetchall()
-            
-                for alert in alert_info:
-                    hostname = alert[3]
-                    Message = hostClearMessage.format(hostname)
-                    apiWebex.messages.create(roomId=WebexRoomID, text=Message)
-                
-                cur.execute(hostAlertToBeRemoved, (id,))
-        
-        conn.commit()
-        
-    except Exception as e:
-        print(f"Error during alertCheckingHosts: {e}")
-        conn.rollback()
-    finally:
-        cur.close()
-
+        with tracing.span("scope"):
+            params, groupMembers, streamOpenIds = fetchCycleScope(IncrementalFetch)
+            for load in loads:
+                if streamOpenIds[load.stream.name] is not None:
+                    load.setOpenIds(streamOpenIds[load.stream.name])
+        with tracing.span("fetch"):
+            for page in cyclePages(params):
+                pageProblems = partitionProblems(page, groupMembers)
+                for load in loads:
+                    load.add(pageProblems[load.stream.name][0])
+    except Exception:
+        # A partial problem set would clear every alert missing from it
+        closeStreamLoads(loads)
+        raise
+    printFetchStats()
+
+    with tracing.span("finish_streams", parallel=ParallelStreams):
+        if ParallelStreams:
+            return finishStreamsParallel(loads)
+        return finishStreamsSequential(loads)
+
+# Delivery worker: drains the outbox on its own DB connection until stopEvent is set.
+# wake, when given, starts the next round early (set by the webhook receiver and on stop).
+def runOutboxWorker(stopEvent, interval, wake=None):
+    workerConn = None
+    lastCleanup = 0.0
+    while not stopEvent.is_set():
+        try:
+            if workerConn is None or workerConn.closed:
+                workerConn = openDatabase()
+            if dispatcher is not None:
+                deliverPending(workerConn, stopEvent)
+            if time.monotonic() - lastCleanup > 3600:
+                cleanupOutbox(workerConn, OutboxRetentionDays)
+                lastCleanup = time.monotonic()
+        except Exception as e:
+            print(f"Error in outbox delivery worker: {e}")
+            if workerConn is not None:
+                workerConn.close()
+            workerConn = None
+        if wake is None:
+            stopEvent.wait(interval)
+        else:
+            wake.wait(interval)
+            wake.clear()
+    if workerConn is not None:
+        workerConn.close()
+
+def installStopHandlers(stopEvent):
+    def handleStop(signum, frame):
+        print(f"Received signal {signum}, stopping after the current cycle")
+        stopEvent.set()
+
+    signal.signal(signal.SIGTERM, handleStop)
+    signal.signal(signal.SIGINT, handleStop)
+
+# Long-running mode: keeps the Zabbix session, Webex client and DB connection across cycles,
+# with the outbox drained continuously by a delivery thread. With webhook the Zabbix events are
+# pushed to webhook.py and the cycles only reconcile what it missed.
+def runDaemon(interval, webhook=False):
+    global alertCache
+    if AlertCacheRefresh:
+        alertCache = AlertCache(AlertCacheRefresh)
+    stopEvent = threading.Event()
+    wake = threading.Event()
+    installStopHandlers(stopEvent)
+
+    receiver = None
+    if webhook:
+        from webhook import WebhookReceiver
+        try:
+            receiver = WebhookReceiver(onQueued=wake.set)
+        except ValueError as e:
+            print(f"Not starting the webhook endpoint: {e}")
+            exit(1)
+
+    connectWebex()
+    worker = threading.Thread(target=runOutboxWorker, args=(stopEvent, OutboxPollInterval, wake), name="outbox")
+    worker.start()
+    if MetricsPort:
+        metrics.startMetricsServer(MetricsHost, MetricsPort)
+    if receiver is not None:
+        receiver.start()
 
-def alertCheckingSites(zabbixData, postgresData):
-    postgres_ids = {int(item[0]) for item in postgresData}
-    zabbix_ids = {int(item[0]) for item in zabbixData}
-    
-    newAlert = zabbix_ids - postgres_ids
-    clearAlert = postgres_ids - zabbix_ids
-    
-    cur = conn.cursor()
     try:
-        if newAlert:
-            for element in zabbixData:
-                if int(element[0]) in newAlert:
-                    valores = (element[0], element[1], element[2], element[3], element[4])
-                    event_name = element[1]
-                    site = element[3]
-                    hostname = element[4]
-                    
-                    room_id = None
-                    Message = ""
-
-                    # Routing logic
-                    if site == "UNKNOWN" or hostname == "UNKNOWN":
-                        room_id = ADMINRoomID
-                        Message = missingInfoMessage.format(site, hostname, event_name)
-                        
-                        if ZabbixURL_ADMIN: 
-                            Message += f"\nMissing info Dashboard:({ZabbixURL_ADMIN})\n:q\n"
-                    else:
-                        # If info is present, use the map. If not in map, use WebexRoomID (general)
-                        room_id = siteRoomMap.get(site, WebexRoomID) 
-                        Message = siteAddMessage.format(site, event_name, hostname)
-                        
-                        # --- Add site dashboard link if it exists ---
-                        dashboard_url = siteDashboardMap.get(site)
-                        if dashboard_url:
-                            Message += f"\nSITE Dashboard:({dashboard_url})\n\n"
-                        
-                    cur.execute(siteAlertTobeAdded, valores)
-                    apiWebex.messages.create(roomId=room_id, text=Message)
-
-        if clearAlert:
-            for id in clearAlert:
-                cur.execute(siteAlertInformationById, (id,))
-                alert_info = cur.fetchall()
-            
-                for alert in alert_info:
-                    event_name = alert[1]
-                    site = alert[3]
-                    hostname = alert[4]
-                    
-                    room_id = None
-                    Message = ""
-
-                    # Routing logic for resolved alerts
-                    if site == "UNKNOWN" or hostname == "UNKNOWN":
-                        room_id = ADMINRoomID
-                        Message = f"Site alert RESOLVED or Data fixed (check site room) Site: {site}, Host: {hostname}, Alert: {event_name}"
-                        # --- Add ADMIN dashboard link if it exists ---
-                        if ZabbixURL_ADMIN: 
-                            Message += f"\nMissing info Dashboard: ({ZabbixURL_ADMIN})\n\n"
-                    else:
-                        room_id = siteRoomMap.get(site, WebexRoomID)
-                        Message = siteClearMessage.format(site, event_name, hostname)
-
-                        # --- Add site dashboard link if it exists ---
-                        dashboard_url = siteDashboardMap.get(site)
-                        if dashboard_url:
-                            Message += f"\nSITE Dashboard: ({dashboard_url})\n\n"
-
-                    apiWebex.messages.create(roomId=room_id, markdown=Message )
-                    
-                cur.execute(siteAlertToBeRemoved, (id,))
-        
-        conn.commit()
-        
-    except Exception as e:
-        print(f"Error during alertCheckingSites: {e}")
-        conn.rollback()
+        while not stopEvent.is_set():
+            started = time.monotonic()
+            try:
+                connectServices()
+                runCycle(deliver=False)
+                if receiver is not None:
+                    print(receiver.summary())
+            except Exception as e:
+                metrics.cycleFailures.inc()
+                # Drop the Zabbix and DB sessions so the next cycle starts from fresh connections
+                print(f"Error during daemon cycle, reconnecting: {e}")
+                closeServices(keepWebex=True)
+            else:
+                if conn.closed:
+                    closeServices(keepWebex=True)
+            stopEvent.wait(max(0, interval - (time.monotonic() - started)))
     finally:
-        cur.close()
-
-#########################################CPOC CHECKING##################################################
-def alertCheckingCPOC(zabbixData, postgresData):
-    postgres_ids = {int(item[0]) for item in postgresData}
-    zabbix_ids = {int(item[0]) for item in zabbixData}
-    
-    newAlert = zabbix_ids - postgres_ids
-    clearAlert = postgres_ids - zabbix_ids
-    
-    cur = conn.cursor()
+        if receiver is not None:
+            receiver.stop()
+        stopEvent.set()
+        wake.set()
+        worker.join()
+        if ShardStreams and healthy(conn):
+            releaseShards(conn, ShardNode, [stream.name for stream in alertStreams])
+        closeServices()
+
+# Standalone delivery worker, for running detection and delivery as separate processes
+def runDeliveryOnly():
+    stopEvent = threading.Event()
+    installStopHandlers(stopEvent)
+    connectWebex()
     try:
-        
-        if newAlert:
-            for element in zabbixData:
-                if int(element[0]) in newAlert:
-                    valores = (element[0], element[1], element[2], element[3], element[4])
-                    event_name = element[1]
-                    site = element[3] 
-                    hostname = element[4]
-                    
-                    
-                    room_id = CPOCRoomID 
-                    Message = cpocAddMessage.format(site, event_name, hostname)
-                    
-                    
-                    dashboard_url = ZabbixURL_CPOC 
-                    if dashboard_url:
-                        Message += f"\nCPOC Dashboard:({dashboard_url})\n\n"
-                    
-                    cur.execute(cpocAlertTobeAdded, valores)
-                    apiWebex.messages.create(roomId=room_id, text=Message)
-
-        
-        if clearAlert:
-            for id in clearAlert:
-                cur.execute(cpocAlertInformationById, (id,))
-                alert_info = cur.fetchall()
-            
-                for alert in alert_info:
-                    event_name = alert[1]
-                    site = alert[3] 
-                    hostname = alert[4]
-                    
-                    
-                    room_id = CPOCRoomID # 
-                    Message = cpocClearMessage.format(site, event_name, hostname)
-                    
-                    
-                    dashboard_url = ZabbixURL_CPOC
-                    if dashboard_url:
-                        Message += f"\nCPOC Dashboard: ({dashboard_url})\n\n"
-
-                    apiWebex.messages.create(roomId=room_id, markdown=Message )
-                    
-                cur.execute(cpocAlertToBeRemoved, (id,))
-        
-        conn.commit()
-        
-    except Exception as e:
-        print(f"Error during alertCheckingCPOC: {e}")
-        conn.rollback()
+        runOutboxWorker(stopEvent, OutboxPollInterval)
     finally:
-        cur.close()
-
+        closeServices()
 
+# One cycle for cron; Webex is only connected by deliverPending() when the outbox has work
+def runOnce():
+    started = time.monotonic()
+    connectZabbix()
+    try:
+        connectDatabase()
+        connectPool()
+    except p.Error as e:
+        print(f"Error connecting to database: {e}")
+        exit(1)
+    print(f"Connected to Zabbix and the database in {time.monotonic() - started:.2f}s")
+    try:
+        runCycle()
+    except Exception:
+        metrics.cycleFailures.inc()
+        raise
+    finally:
+        if streamExecutor is not None:
+            streamExecutor.shutdown(wait=True)
+        closeServices()
+        if MetricsTextfile:
+            metrics.writeTextfile(MetricsTextfile)
 
-try:
-    alertCheckingHosts(getCurrentProblems(), getDBexistingProblems())
-    alertCheckingSites(getSiteProblems(), getDBSiteProblems())
-    alertCheckingCPOC(getCPOCProblems(), getDBCPOCProblems()) # <-- Ejecución de la lógica CPOC
 
-finally:
-    conn.close()
\ No newline at end of file
+# Before any engine, worker or webhook touches the tables: missing tables and migrations are
+# applied (schema.ensureSchema); a database that cannot be brought up to date stops the run
+def checkSchema():
+    try:
+        dbconn = openDatabase()
+        try:
+            ensureSchema(dbconn)
+        finally:
+            dbconn.close()
+    except p.Error as e:
+        print(f"Error checking the database schema: {e}")
+        exit(1)
+
+# The check subcommand of cli.py
+def runCheck(args):
+    global IncrementalFetch
+    IncrementalFetch = args.incremental
+
+    if args.use_async and ShardStreams:
+        print("--async holds no stream leases and cannot run with Shard_Streams=true")
+        exit(1)
+    if args.use_async and (args.webhook or args.outbox_worker):
+        print("--async delivers its own outbox and takes no webhook events, it cannot run with --webhook or --outbox-worker")
+        exit(1)
+    checkSchema()
+    if args.use_async:
+        # Imported here so aiohttp/asyncpg are only needed for this mode
+        import asyncengine
+        asyncengine.main(args.incremental, args.daemon, args.interval)
+    elif args.outbox_worker:
+        runDeliveryOnly()
+    elif args.daemon:
+        runDaemon(args.interval, args.webhook)
+    else:
+        runOnce()
+
+
+# Kept for existing cron entries: "newchecks.py [flags]" is "cli.py check [flags]"
+if __name__ == "__main__":
+    import sys
+    import cli
+    sys.modules["newchecks"] = sys.modules["__main__"] # already loaded, cli must not import it again
+    cli.main(["check"] + sys.argv[1:])
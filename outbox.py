@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+# Transactional outbox for Webex notifications.
+# The reconcilers in newchecks.py write their messages into webexoutbox in the
+# same transaction as the alert rows. deliverOutbox() later claims pending rows
+# with a lease, sends them through the dispatcher and marks them delivered, or
+# pushes them back with exponential backoff. A crash between sending and marking
+# only makes the lease expire, so a message is re-sent at most once per lease.
+import time
+import psycopg2 as p
+from concurrent.futures import TimeoutError
+from database import execute, executeValues
+import metrics
+
+## Queries - OUTBOX
+outboxInsert = "INSERT INTO webexoutbox (roomid, format, body, kind, label, hostname, eventname) VALUES %s"
+outboxClaim = """UPDATE webexoutbox SET attempts = attempts + 1, next_attempt = now() + make_interval(secs => %s)
+    WHERE id IN (
+        SELECT id FROM webexoutbox
+        WHERE delivered IS NULL AND attempts < %s AND next_attempt <= now()
+        ORDER BY id LIMIT %s FOR UPDATE SKIP LOCKED)
+    RETURNING id, roomid, format, body, kind, label, hostname, eventname;"""
+outboxMarkDelivered = "UPDATE webexoutbox SET delivered = now(), last_error = NULL WHERE id = ANY(%s);"
+outboxMarkFailed = """UPDATE webexoutbox
+    SET next_attempt = now() + make_interval(secs => least(%s * power(2, attempts - 1), %s)), last_error = %s
+    WHERE id = ANY(%s);"""
+outboxDue = "SELECT EXISTS (SELECT 1 FROM webexoutbox WHERE delivered IS NULL AND attempts < %s AND next_attempt <= now());"
+outboxCleanup = "DELETE FROM webexoutbox WHERE delivered < now() - make_interval(days => %s);"
+
+
+# Called by a reconciler with its open cursor, before conn.commit()
+def queueNotifications(cur, outgoing):
+    rows = []
+    for room_id, message, kind, label, hostname, event_name in outgoing:
+        msgFormat, body = next(iter(message.items()))
+        rows.append((room_id, msgFormat, body, kind, label, hostname, event_name))
+    if rows:
+        executeValues(cur, "outbox_insert", outboxInsert, rows)
+
+
+# Whether deliverOutbox() would find anything to claim right now
+def outboxPending(conn, maxAttempts):
+    cur = conn.cursor()
+    try:
+        execute(cur, "outbox_due", outboxDue, (maxAttempts,))
+        due = cur.fetchone()[0]
+        conn.commit()
+        return due
+    except p.Error as e:
+        print(f"Error checking Webex outbox: {e}")
+        conn.rollback()
+        return False
+    finally:
+        cur.close()
+
+
+def claimBatch(conn, batchSize, lease, maxAttempts):
+    cur = conn.cursor()
+    try:
+        execute(cur, "outbox_claim", outboxClaim, (lease, maxAttempts, batchSize))
+        rows = sorted(cur.fetchall())
+        conn.commit()
+        return rows
+    except p.Error as e:
+        print(f"Error claiming Webex outbox rows: {e}")
+        conn.rollback()
+        return []
+    finally:
+        cur.close()
+
+
+def markResults(conn, delivered, failed, backoffBase, backoffMax):
+    cur = conn.cursor()
+    try:
+        if delivered:
+            execute(cur, "outbox_mark_delivered", outboxMarkDelivered, (delivered,))
+        if failed:
+            execute(cur, "outbox_mark_failed", outboxMarkFailed, (backoffBase, backoffMax, "Webex delivery failed", failed))
+        conn.commit()
+    except p.Error as e:
+        # Rows stay claimed until the lease runs out and are retried then
+        print(f"Error updating Webex outbox rows: {e}")
+        conn.rollback()
+    finally:
+        cur.close()
+
+
+# Waits for one send until the batch deadline, in short steps so a stop does not sit it out.
+# Raises TimeoutError when the send is still running at the deadline or once stopEvent is set.
+def waitDelivery(future, deadline, stopEvent):
+    while True:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0 or (stopEvent is not None and stopEvent.is_set()):
+            return future.result(0)
+        try:
+            return future.result(min(remaining, 1.0))
+        except TimeoutError:
+            pass
+
+# Drains the outbox in batches, stopping between batches once stopEvent is set.
+# timeout bounds the wait for a whole batch. Returns (rows delivered, rows failed, messages sent, digests sent).
+def deliverOutbox(conn, dispatcher, digester, batchSize=500, lease=300, maxAttempts=10,
+                  backoffBase=5, backoffMax=900, timeout=120, stopEvent=None):
+    totals = [0, 0, 0, 0]
+    while stopEvent is None or not stopEvent.is_set():
+        rows = claimBatch(conn, batchSize, lease, maxAttempts)
+        if not rows:
+            break
+
+        for outboxid, room_id, msgFormat, body, kind, label, hostname, event_name in rows:
+            digester.add(room_id, {msgFormat: body}, kind, label, hostname, event_name, ref=outboxid)
+
+        delivered = []
+        failed = []
+        deadline = time.monotonic() + timeout
+        for result, refs, isDigest in digester.flush(dispatcher.send):
+            try:
+                ok = waitDelivery(result, deadline, stopEvent)
+            except TimeoutError:
+                # Left claimed; the lease decides when it is tried again
+                continue
+            if ok:
+                delivered.extend(refs)
+            else:
+                failed.extend(refs)
+            totals[3 if isDigest else 2] += 1
+
+        markResults(conn, delivered, failed, backoffBase, backoffMax)
+        metrics.outboxRows.inc(len(delivered), result="delivered")
+        metrics.outboxRows.inc(len(failed), result="failed")
+        totals[0] += len(delivered)
+        totals[1] += len(failed)
+
+        if len(rows) < batchSize:
+            break
+    return tuple(totals)
+
+
+def cleanupOutbox(conn, retentionDays):
+    cur = conn.cursor()
+    try:
+        execute(cur, "outbox_cleanup", outboxCleanup, (retentionDays,))
+        conn.commit()
+    except p.Error as e:
+        print(f"Error cleaning up Webex outbox: {e}")
+        conn.rollback()
+    finally:
+        cur.close()
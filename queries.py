@@ -0,0 +1,55 @@
+#!/usr/bin/env python3
+# SQL and Zabbix request parameters shared by the sync (newchecks.py) and asyncio (asyncengine.py) engines.
+# SQL uses psycopg2 %s placeholders; numberedQuery() converts them for PREPARE and asyncpg.
+
+# %s placeholders -> $1, $2, ...
+def numberedQuery(query):
+    parts = query.split("%s")
+    return "".join(part + (f"${index + 1}" if index < len(parts) - 1 else "") for index, part in enumerate(parts))
+
+## Queries - ZABBIX SNAPSHOT (per-transaction temp tables used by the set-based reconcilers)
+snapshotTables = """
+    CREATE TEMP TABLE zabbix_rows (eventid BIGINT PRIMARY KEY, name VARCHAR(250), clock BIGINT, site VARCHAR(250), hostname VARCHAR(250)) ON COMMIT DROP;
+    CREATE TEMP TABLE zabbix_open (eventid BIGINT PRIMARY KEY) ON COMMIT DROP;"""
+snapshotColumns = "eventid, name, clock, site, hostname"
+snapshotRowsInsert = "INSERT INTO zabbix_rows (eventid, name, clock, site, hostname) VALUES %s ON CONFLICT DO NOTHING"
+snapshotOpenInsert = "INSERT INTO zabbix_open (eventid) VALUES %s ON CONFLICT DO NOTHING"
+snapshotOpenFromRows = "INSERT INTO zabbix_open (eventid) SELECT eventid FROM zabbix_rows;"
+
+## Queries - WATERMARKS (incremental fetching)
+watermarkSelect = "SELECT stream, eventid, clock FROM alertwatermarks WHERE stream = ANY(%s);"
+watermarkUpsert = "INSERT INTO alertwatermarks (stream, eventid, clock) VALUES (%s, %s, %s) ON CONFLICT (stream) DO UPDATE SET eventid = EXCLUDED.eventid, clock = EXCLUDED.clock;"
+
+## Queries - CLEARED BY THE WEBHOOK (eventids never reopen, a reconcile that fetched them earlier must not re-add them)
+# Entries older than a day have outlived any cycle and are pruned by the same statement
+clearedInsert = """WITH pruned AS (DELETE FROM alertcleared WHERE stream = %s AND cleared < now() - interval '1 day')
+    INSERT INTO alertcleared (stream, eventid) VALUES (%s, %s) ON CONFLICT DO NOTHING;"""
+
+## Zabbix requests
+# All severity 5 (disaster) problems with their tags, optionally only those past a watermark and
+# up to the last eventid an id-only query already saw (eventidTill).
+# objectid (the trigger) is what hostmetadata.py resolves hosts from; tags=False leaves the tags to it.
+def disasterParams(eventidFrom=None, tags=True, objectid=False, eventidTill=None):
+    request_param = {
+                    "output" : ["name","eventid","clock"],
+                    "severities" : 5
+                     }
+    if tags:
+        request_param["selectTags"] = "extend"
+    if objectid:
+        request_param["output"].append("objectid")
+    if eventidFrom is not None:
+        request_param["eventid_from"] = str(eventidFrom)
+    if eventidTill is not None:
+        request_param["eventid_till"] = str(eventidTill)
+    return request_param
+
+# Only the eventids of open severity 5 problems (no tags, no names), optionally for one host group
+def eventIdParams(groupid=None):
+    request_param = {
+                    "output" : ["eventid"],
+                    "severities" : 5
+                     }
+    if groupid is not None:
+        request_param["groupids"] = [groupid]
+    return request_param
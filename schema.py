@@ -0,0 +1,173 @@
+#!/usr/bin/env python3
+# Table layout for the alert streams and its migrations.
+# migrate() is idempotent: it creates whatever is missing for the registered streams,
+# converts tables still in the original layout (INTEGER eventid, VARCHAR clock) to the
+# typed one and records applied migrations in schemaversion. Reporting queries can use
+# the allalerts view, which spans every stream table with a stream column.
+# "cli.py check" calls ensureSchema() at startup, which only migrates when something is missing.
+import re
+import psycopg2 as p
+from streams import alertStreams
+
+## Tables - shared by every stream
+supportTables = """
+    CREATE TABLE IF NOT EXISTS alertwatermarks (
+        stream VARCHAR(50) PRIMARY KEY,
+        eventid BIGINT NOT NULL,
+        clock VARCHAR(50)
+        );
+    CREATE TABLE IF NOT EXISTS webexoutbox (
+        id BIGSERIAL PRIMARY KEY,
+        roomid VARCHAR(250),
+        format VARCHAR(10) NOT NULL,
+        body TEXT NOT NULL,
+        kind VARCHAR(10) NOT NULL,
+        label VARCHAR(250),
+        hostname VARCHAR(250),
+        eventname VARCHAR(250),
+        created TIMESTAMPTZ NOT NULL DEFAULT now(),
+        attempts INTEGER NOT NULL DEFAULT 0,
+        next_attempt TIMESTAMPTZ NOT NULL DEFAULT now(),
+        delivered TIMESTAMPTZ,
+        last_error TEXT
+        );
+    CREATE INDEX IF NOT EXISTS webexoutbox_pending ON webexoutbox (next_attempt) WHERE delivered IS NULL;
+    CREATE TABLE IF NOT EXISTS shardnodes (
+        node VARCHAR(250) PRIMARY KEY,
+        heartbeat TIMESTAMPTZ NOT NULL
+        );
+    CREATE TABLE IF NOT EXISTS streamleases (
+        stream VARCHAR(50) PRIMARY KEY,
+        owner VARCHAR(250) NOT NULL,
+        expires TIMESTAMPTZ NOT NULL
+        );
+    CREATE TABLE IF NOT EXISTS alertversions (
+        stream VARCHAR(50) PRIMARY KEY,
+        version BIGINT NOT NULL
+        );
+    CREATE TABLE IF NOT EXISTS alertflaps (
+        stream VARCHAR(50) NOT NULL,
+        site VARCHAR(250) NOT NULL DEFAULT '',
+        hostname VARCHAR(250) NOT NULL,
+        name VARCHAR(250) NOT NULL,
+        transitions INTEGER NOT NULL,
+        window_start TIMESTAMPTZ NOT NULL,
+        last_change TIMESTAMPTZ NOT NULL,
+        flapping BOOLEAN NOT NULL DEFAULT false,
+        PRIMARY KEY (stream, site, hostname, name)
+        );
+    CREATE INDEX IF NOT EXISTS alertflaps_flapping ON alertflaps (stream, last_change) WHERE flapping;
+    CREATE TABLE IF NOT EXISTS alertcleared (
+        stream VARCHAR(50) NOT NULL,
+        eventid BIGINT NOT NULL,
+        cleared TIMESTAMPTZ NOT NULL DEFAULT now(),
+        PRIMARY KEY (stream, eventid)
+        );
+    CREATE TABLE IF NOT EXISTS schemaversion (
+        version INTEGER PRIMARY KEY,
+        description VARCHAR(250) NOT NULL,
+        applied TIMESTAMPTZ NOT NULL DEFAULT now()
+        );"""
+
+## Tables - one per stream
+def streamTable(stream):
+    site = "\n        site VARCHAR(250) NOT NULL," if stream.withSite else ""
+    return f"""
+    CREATE TABLE IF NOT EXISTS {stream.table} (
+        eventid BIGINT PRIMARY KEY,
+        name VARCHAR(250) NOT NULL,
+        clock TIMESTAMPTZ NOT NULL,{site}
+        hostname VARCHAR(250) NOT NULL
+        );"""
+
+# Age, host and site lookups; the reconcilers themselves only need the eventid primary key
+def streamIndexes(stream):
+    indexes = f"""
+    CREATE INDEX IF NOT EXISTS {stream.table}_clock ON {stream.table} (clock);
+    CREATE INDEX IF NOT EXISTS {stream.table}_hostname ON {stream.table} (hostname);"""
+    if stream.withSite:
+        indexes += f"""
+    CREATE INDEX IF NOT EXISTS {stream.table}_site ON {stream.table} (site, clock);"""
+    return indexes
+
+def allAlertsView():
+    selects = []
+    for stream in alertStreams:
+        site = "site" if stream.withSite else "NULL::varchar(250) AS site"
+        selects.append(f"SELECT '{stream.name}'::varchar(50) AS stream, eventid, name, clock, {site}, hostname FROM {stream.table}")
+    return "CREATE OR REPLACE VIEW allalerts AS\n    " + "\n    UNION ALL ".join(selects) + ";"
+
+
+#########################################MIGRATIONS##################################################
+columnTypes = "SELECT column_name, data_type, character_maximum_length FROM information_schema.columns WHERE table_schema = current_schema() AND table_name = %s;"
+
+# 1: BIGINT eventid, TIMESTAMPTZ clock (Zabbix clock is epoch seconds), wider site/hostname
+def typedAlertColumns(cur):
+    for stream in alertStreams:
+        cur.execute(columnTypes, (stream.table,))
+        rows = cur.fetchall()
+        types = {name: dataType for name, dataType, length in rows}
+        lengths = {name: length for name, dataType, length in rows}
+        changes = []
+        if types.get("eventid") == "integer":
+            changes.append("ALTER COLUMN eventid TYPE BIGINT")
+        if types.get("clock") == "character varying":
+            changes.append("ALTER COLUMN clock TYPE TIMESTAMPTZ USING to_timestamp(clock::bigint)")
+        for column in ("site", "hostname"):
+            if column in types and lengths[column] != 250:
+                changes.append(f"ALTER COLUMN {column} TYPE VARCHAR(250)")
+        if changes:
+            print(f"Migrating {stream.table}: {', '.join(changes)}")
+            cur.execute(f"ALTER TABLE {stream.table} {', '.join(changes)};")
+
+migrations = [
+    (1, "typed alert columns", typedAlertColumns),
+]
+
+def migrate(conn):
+    cur = conn.cursor()
+    try:
+        # Nodes starting at the same time migrate one after the other
+        cur.execute("SELECT pg_advisory_xact_lock(hashtext('zabbixwebex:schema'));")
+        cur.execute(supportTables)
+        for stream in alertStreams:
+            cur.execute(streamTable(stream))
+
+        cur.execute("SELECT version FROM schemaversion;")
+        applied = {row[0] for row in cur.fetchall()}
+        for version, description, apply in migrations:
+            if version not in applied:
+                print(f"Applying schema migration {version}: {description}")
+                apply(cur)
+                cur.execute("INSERT INTO schemaversion (version, description) VALUES (%s, %s);", (version, description))
+
+        for stream in alertStreams:
+            cur.execute(streamIndexes(stream))
+        cur.execute(allAlertsView())
+        conn.commit()
+    except p.Error as e:
+        print(f"Error migrating database schema: {e}")
+        conn.rollback()
+        raise
+    finally:
+        cur.close()
+
+supportTableNames = re.findall(r"CREATE TABLE IF NOT EXISTS (\w+)", supportTables)
+
+# Startup check: migrate() only runs when a table is missing or a migration is not applied yet,
+# so a normal start takes no DDL locks. Raises p.Error like migrate().
+def ensureSchema(conn):
+    cur = conn.cursor()
+    try:
+        tables = supportTableNames + [stream.table for stream in alertStreams]
+        cur.execute("SELECT count(*) FROM unnest(%s::text[]) AS t (name) WHERE to_regclass(t.name) IS NULL;", (tables,))
+        missing = cur.fetchone()[0]
+        applied = set()
+        if not missing:
+            cur.execute("SELECT version FROM schemaversion;")
+            applied = {row[0] for row in cur.fetchall()}
+        conn.commit()
+    finally:
+        cur.close()
+    if missing or any(version not in applied for version, description, apply in migrations):
+        migrate(conn)
@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+# Environment configuration shared by newchecks.py and its sync/asyncio engines.
+# Room ids, dashboards and message templates live with the stream definitions in streams.py.
+import os
+import socket
+from dotenv import load_dotenv
+load_dotenv()
+
+# Getting environmental variables
+# Tokens
+tokenWebex = os.getenv("Webex_Api_Token")
+ZabbixToken = os.getenv("Zabbix_API_Token")
+# API requirements
+ZabbixURL= os.getenv("Zabbix_URL")
+# Database information
+DatabaseName = os.getenv("Database_Name")
+DatabaseUsername = os.getenv("Database_Username")
+DatabasePassword = os.getenv("Database_Password")
+DatabaseIp = os.getenv("Database_Ip")
+DatabasePort = os.getenv("Database_Port")
+DatabaseSchema = os.getenv("Database_Schema") # optional search_path for the alert tables
+# Webex API base URL (override to point at a local stand-in)
+WebexApiURL = os.getenv("Webex_Api_Url", "https://webexapis.com/v1/")
+
+# Database connection params:
+databaseParams = {
+    "dbname": DatabaseName,
+    "user": DatabaseUsername,
+    "password": DatabasePassword,
+    "host": DatabaseIp,
+    "port": DatabasePort
+}
+if DatabaseSchema:
+    databaseParams["options"] = f"-c search_path={DatabaseSchema}"
+
+# Database tuning
+BatchPageSize = int(os.getenv("DB_Batch_Page_Size", "1000")) # rows per multi-row INSERT when loading the snapshot
+
+# Zabbix instances, polled concurrently. The first one uses Zabbix_URL/Zabbix_API_Token, the
+# others Zabbix_URL_<NAME>/Zabbix_API_Token_<NAME> plus an optional Zabbix_Group_Map_<NAME>
+# ("557:1234,551:1240", stream host group -> that instance's group id). Only append new names:
+# an instance's position is part of the eventids stored for it (see zabbixinstances.py).
+def zabbixInstanceSettings(names):
+    instances = []
+    for index, name in enumerate(names):
+        key = name.upper()
+        groupMap = {}
+        for pair in os.getenv(f"Zabbix_Group_Map_{key}", "").split(","):
+            if ":" in pair:
+                streamGroup, instanceGroup = pair.split(":")
+                groupMap[int(streamGroup)] = int(instanceGroup)
+        instances.append({
+            "name": name,
+            "url": os.getenv(f"Zabbix_URL_{key}", ZabbixURL if index == 0 else None),
+            "token": os.getenv(f"Zabbix_API_Token_{key}", ZabbixToken if index == 0 else None),
+            "groupMap": groupMap
+        })
+    return instances
+
+ZabbixInstances = zabbixInstanceSettings([name.strip() for name in os.getenv("Zabbix_Instances", "main").split(",") if name.strip()])
+
+# Zabbix fetching
+ZabbixPageSize = int(os.getenv("Zabbix_Page_Size", "5000")) # problems per problem.get page (0 = one response with everything)
+
+# Host metadata cache (see hostmetadata.py)
+HostMetadataTTL = int(os.getenv("Host_Metadata_TTL", "0")) # seconds host tags are cached; 0 leaves problems with the tags they have
+HostMetadataSize = int(os.getenv("Host_Metadata_Max_Hosts", "50000")) # hosts kept per Zabbix instance
+ProblemTags = os.getenv("Zabbix_Problem_Tags", "true").lower() == "true" # false drops selectTags, needs Host_Metadata_TTL
+
+# Daemon settings
+PollInterval = int(os.getenv("Poll_Interval", "30")) # seconds between cycles in daemon mode
+IncrementalFetch = os.getenv("Incremental_Fetch", "false").lower() == "true" # only download problems past the stored watermark
+
+# Stream execution
+ParallelStreams = os.getenv("Parallel_Streams", "true").lower() == "true" # reconcile streams concurrently, one pooled connection each
+CycleDeadline = int(os.getenv("Cycle_Deadline", "120")) # seconds a cycle waits for its streams before reporting them as late
+DBPoolSize = int(os.getenv("DB_Pool_Size", "5")) # max pooled DB connections, at least one per stream
+DBPreparedStatements = os.getenv("DB_Prepared_Statements", "true").lower() == "true" # PREPARE reconciler statements once per connection
+DBHealthCheckAfter = int(os.getenv("DB_Health_Check_After", "30")) # seconds idle after which a connection is pinged before reuse
+AlertCacheRefresh = int(os.getenv("Alert_Cache_Refresh", "3600")) # daemon: seconds the cached open alert ids are trusted (0 disables the cache)
+
+# Sharding streams across nodes (see sharding.py)
+ShardStreams = os.getenv("Shard_Streams", "false").lower() == "true" # only reconcile the streams this node holds a lease on
+ShardNode = os.getenv("Shard_Node_Id", f"{socket.gethostname()}-{os.getpid()}") # unique per running node
+ShardLease = int(os.getenv("Shard_Lease", "90")) # seconds a stream lease lasts without renewal (keep above the poll interval)
+
+# Zabbix webhook ingestion (newchecks.py --daemon --webhook, see webhook.py)
+WebhookHost = os.getenv("Webhook_Host", "127.0.0.1") # other addresses need Webhook_Token
+WebhookPort = int(os.getenv("Webhook_Port", "8085"))
+WebhookToken = os.getenv("Webhook_Token") # expected as "Authorization: Bearer <token>"
+WebhookMaxBody = int(os.getenv("Webhook_Max_Body", "65536")) # bytes, larger events are refused with 413
+WebhookPoolSize = int(os.getenv("Webhook_Pool_Size", "4")) # DB connections for concurrent webhook events
+
+# Prometheus metrics (see metrics.py)
+MetricsHost = os.getenv("Metrics_Host", "0.0.0.0")
+MetricsPort = int(os.getenv("Metrics_Port", "0")) # daemon: serve /metrics on this port (0 disables)
+MetricsTextfile = os.getenv("Metrics_Textfile") # one-shot runs: write the metrics here for the textfile collector
+
+# Slow-cycle traces (see tracing.py)
+TraceSlowCycle = float(os.getenv("Trace_Slow_Cycle", "0")) # seconds above which a cycle's trace is written (0 disables tracing)
+TraceDir = os.getenv("Trace_Dir", "traces")
+TraceProfile = os.getenv("Trace_Profile", "none").lower() # none, sample or cprofile
+TraceSampleInterval = int(os.getenv("Trace_Sample_Interval", "10")) # milliseconds between stack samples
+
+# Webex dispatch settings
+WebexMaxWorkers = int(os.getenv("Webex_Max_Workers", "8")) # concurrent messages overall
+WebexRoomConcurrency = int(os.getenv("Webex_Room_Concurrency", "1")) # concurrent messages per room (1 keeps room order)
+WebexMaxRetries = int(os.getenv("Webex_Max_Retries", "3")) # retries after a 429 before giving up on a message
+WebexFlushTimeout = int(os.getenv("Webex_Flush_Timeout", "300")) # seconds a cycle waits for queued messages
+
+# Alert storm digests
+DigestThreshold = int(os.getenv("Digest_Threshold", "10")) # messages per room per cycle above which one digest is sent (0 disables)
+DigestMaxHosts = int(os.getenv("Digest_Max_Hosts", "20")) # hosts listed per digest section
+
+# Flap suppression (see flapping.py)
+FlapThreshold = int(os.getenv("Flap_Threshold", "6")) # new/resolved changes of one site, host and problem within the window that make it flap (0 disables)
+FlapWindow = int(os.getenv("Flap_Window", "3600")) # seconds the changes are counted over
+FlapHoldDown = int(os.getenv("Flap_Hold_Down", "1800")) # seconds without a change before a flapping alert is announced as stable
+
+# Webex outbox delivery
+OutboxBatchSize = int(os.getenv("Outbox_Batch_Size", "500")) # rows claimed per delivery batch
+OutboxLease = int(os.getenv("Outbox_Lease", "300")) # seconds a claimed row is hidden from other workers
+OutboxMaxAttempts = int(os.getenv("Outbox_Max_Attempts", "10")) # attempts before a message is left undelivered
+OutboxBackoffBase = int(os.getenv("Outbox_Backoff_Base", "5")) # seconds, doubled after every failed attempt
+OutboxBackoffMax = int(os.getenv("Outbox_Backoff_Max", "900")) # upper bound for the retry delay
+OutboxPollInterval = int(os.getenv("Outbox_Poll_Interval", "2")) # seconds between outbox polls of the delivery worker
+OutboxRetentionDays = int(os.getenv("Outbox_Retention_Days", "7")) # delivered rows older than this are deleted
@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+# Splitting the alert streams across several newchecks.py nodes (Shard_Streams=true).
+# Every node heartbeats into shardnodes and holds leases on its streams in streamleases.
+# Each cycle a node renews what it owns up to its fair share (streams / live nodes),
+# releases the rest and claims free or expired streams, so a dead node's streams are
+# taken over once its leases run out. The reconcile transaction of a stream also takes
+# a transaction-level advisory lock, so two nodes never reconcile the same stream at once
+# even if a lease expired mid-cycle. Outbox delivery needs nothing extra: claims already
+# use FOR UPDATE SKIP LOCKED. Unsharded reconciles, the asyncio engine and webhook.py wait for
+# the same lock instead, so a pushed event is never applied in the middle of a stream's commit.
+# The asyncio engine holds no leases, so it does not run sharded.
+import math
+import psycopg2 as p
+from database import execute
+
+## Queries - SHARDING
+nodeHeartbeat = "INSERT INTO shardnodes (node, heartbeat) VALUES (%s, now()) ON CONFLICT (node) DO UPDATE SET heartbeat = now();"
+liveNodes = "SELECT count(*) FROM shardnodes WHERE heartbeat > now() - make_interval(secs => %s);"
+ownedLeases = "SELECT stream FROM streamleases WHERE owner = %s AND expires > now() ORDER BY stream;"
+leaseClaim = """INSERT INTO streamleases (stream, owner, expires) VALUES (%s, %s, now() + make_interval(secs => %s))
+    ON CONFLICT (stream) DO UPDATE SET owner = EXCLUDED.owner, expires = EXCLUDED.expires
+    WHERE streamleases.owner = EXCLUDED.owner OR streamleases.expires <= now()
+    RETURNING stream;"""
+leaseRelease = "DELETE FROM streamleases WHERE owner = %s AND stream = ANY(%s);"
+nodeRemove = "DELETE FROM shardnodes WHERE node = %s;"
+streamLock = "SELECT pg_try_advisory_xact_lock(hashtext(%s));"
+streamWait = "SELECT pg_advisory_xact_lock(hashtext(%s));"
+
+# Advisory lock key of a stream, also taken by asyncengine.py
+def streamLockKey(streamName):
+    return f"zabbixwebex:{streamName}"
+
+
+# Returns the stream names this node reconciles this cycle
+def claimShards(conn, node, streamNames, lease):
+    cur = conn.cursor()
+    try:
+        execute(cur, "shard_heartbeat", nodeHeartbeat, (node,))
+        execute(cur, "shard_live_nodes", liveNodes, (lease,))
+        share = math.ceil(len(streamNames) / max(1, cur.fetchone()[0]))
+
+        execute(cur, "shard_owned", ownedLeases, (node,))
+        owned = [row[0] for row in cur.fetchall() if row[0] in streamNames]
+        keep, release = owned[:share], owned[share:]
+        if release:
+            execute(cur, "shard_release", leaseRelease, (node, release))
+
+        # Renewing what we keep first, then filling the share with free or expired streams
+        claimed = []
+        for stream in keep + [name for name in streamNames if name not in owned]:
+            if len(claimed) >= share:
+                break
+            execute(cur, "shard_claim", leaseClaim, (stream, node, lease))
+            if cur.fetchone():
+                claimed.append(stream)
+        conn.commit()
+        return set(claimed)
+    except p.Error as e:
+        # Without leases this node reconciles nothing; the others take over
+        print(f"Error claiming stream shards: {e}")
+        conn.rollback()
+        return set()
+    finally:
+        cur.close()
+
+# Handing everything back on shutdown, so other nodes take over without waiting for the lease
+def releaseShards(conn, node, streamNames):
+    cur = conn.cursor()
+    try:
+        execute(cur, "shard_release", leaseRelease, (node, list(streamNames)))
+        execute(cur, "shard_remove", nodeRemove, (node,))
+        conn.commit()
+    except p.Error as e:
+        print(f"Error releasing stream shards: {e}")
+        conn.rollback()
+    finally:
+        cur.close()
+
+# Inside the stream's transaction; False means another node is reconciling it right now.
+# wait blocks until the lock is free instead (always True).
+def lockStream(cur, streamName, wait=False):
+    if wait:
+        # pg_advisory_xact_lock returns void, getting a row back means the lock is held
+        execute(cur, "shard_wait", streamWait, (streamLockKey(streamName),))
+        cur.fetchone()
+        return True
+    execute(cur, "shard_lock", streamLock, (streamLockKey(streamName),))
+    return cur.fetchone()[0]
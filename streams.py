@@ -0,0 +1,284 @@
+#!/usr/bin/env python3
+# Alert stream definitions shared by newchecks.py and zabbixpersite.py.
+# A stream says which Zabbix problems it takes (host group, problem name),
+# how tags become the site/hostname columns, which table stores the alerts and
+# how new/cleared alerts are routed to Webex rooms. Adding a group means
+# registering one more AlertStream here plus its table; the engine in
+# newchecks.py runs every registered stream from the same shared fetch.
+import os
+from collections import namedtuple
+from zabbixinstances import InstanceIdOffset
+from dotenv import load_dotenv
+load_dotenv()
+
+# Webex rooms
+WebexRoomID = os.getenv("Webex_Room_Id") # Fallback for known but unmapped sites
+RTPRoomID = os.getenv("RTP_Room_Id")
+SJCRoomID = os.getenv("SJC_Room_Id")
+LONRoomID = os.getenv("LON_Room_Id")
+SNGRoomID = os.getenv("SNG_Room_Id")
+SYDRoomID = os.getenv("SYD_Room_Id")
+IDEVRoomID = os.getenv("IDEV_Room_Id")
+CPOCRoomID = os.getenv("CPOC_Room_Id")
+ADMINRoomID = os.getenv("ADMIN_Room_Id") # Room for alerts with missing data
+
+# --- Dashboard URLs per Site ---
+ZabbixURL_RTP = os.getenv("ZabbixURL_RTP")
+ZabbixURL_SJC = os.getenv("ZabbixURL_SJC")
+ZabbixURL_LON = os.getenv("ZabbixURL_LON")
+ZabbixURL_SNG = os.getenv("ZabbixURL_SNG")
+ZabbixURL_SYD = os.getenv("ZabbixURL_SYD")
+ZabbixURL_IDEV = os.getenv("ZabbixURL_IDEV")
+ZabbixURL_CPOC = os.getenv("ZabbixURL_CPOC")
+ZabbixURL_ADMIN = os.getenv("ZabbixURL_ADMIN")
+
+siteRoomMap = {
+    "SJC": SJCRoomID,
+    "RTP": RTPRoomID,
+    "LON": LONRoomID,
+    "SNG": SNGRoomID,
+    "SYD": SYDRoomID,
+    "IDEV": IDEVRoomID,
+    "CPOC": CPOCRoomID
+}
+
+# --- New Mapping for Dashboards ---
+siteDashboardMap = {
+    "SJC": ZabbixURL_SJC,
+    "RTP": ZabbixURL_RTP,
+    "LON": ZabbixURL_LON,
+    "SNG": ZabbixURL_SNG,
+    "SYD": ZabbixURL_SYD,
+    "IDEV": ZabbixURL_IDEV,
+    "CPOC": ZabbixURL_CPOC,
+}
+
+# Host group ids
+SiteGroupID = 557
+CPOCGroupID = 551
+
+## Messages - HOSTS
+hostClearMessage = "VMWare host: {} is up **resolved** "
+hostAddMessage = "New triggered alert for host: {} description: {}"
+
+## Messages - SITES
+siteClearMessage = "Site alert **resolved** in {}: {} (Host: {})"
+siteAddMessage = "New site alert in {}: {} (Host: {})"
+
+## Messages - CPOC
+cpocClearMessage = "CPOC alert **resolved** in {}: {} (Host: {})"
+cpocAddMessage = "New CPOC alert in {}: {} (Host: {})"
+
+# Message for alerts with 'UNKNOWN' data
+missingInfoMessage = "Site alert with missing info (sent to Admin). Site: {}, Host: {}. Alert: {}"
+
+
+# One parsed problem: int eventid, int clock (epoch seconds), site and hostname already pulled
+# from the tags. A tuple subclass, so it is as small as a plain tuple and goes straight into
+# execute_values/COPY; RETURNING rows are wrapped with AlertRow._make for routing.
+AlertRow = namedtuple("AlertRow", "eventid name clock site hostname")
+
+
+class AlertStream:
+    # groupid None takes every severity 5 problem. A tag default of None means the tag is
+    # required and problems without it are skipped; siteTag None with a default pins the site.
+    def __init__(self, name, table, route, groupid=None, problemName=None,
+                 siteTag=None, siteDefault=None, hostTag="hostname", hostDefault=None, withSite=True):
+        self.name = name
+        self.table = table
+        self.route = route
+        self.groupid = groupid
+        self.problemName = problemName
+        self.siteTag = siteTag
+        self.siteDefault = siteDefault
+        self.hostTag = hostTag
+        self.hostDefault = hostDefault
+        self.withSite = withSite
+
+        # Every stream hands AlertRows to the engine; clock is stored as TIMESTAMPTZ
+        if withSite:
+            columns = "eventid, name, clock, site, hostname"
+            returning = columns
+        else:
+            columns = "eventid, name, clock, hostname"
+            returning = "eventid, name, clock, NULL::varchar AS site, hostname"
+        self.columns = columns
+        selects = ["to_timestamp(z.clock)" if column == "clock" else "z." + column for column in columns.split(", ")]
+        newRows = f"""INSERT INTO {table} ({columns})
+    SELECT {", ".join(selects)} FROM zabbix_rows z
+    WHERE NOT EXISTS (SELECT 1 FROM {table} a WHERE a.eventid = z.eventid)
+    AND NOT EXISTS (SELECT 1 FROM alertcleared c WHERE c.stream = '{name}' AND c.eventid = z.eventid)"""
+        self.insertNew = f"{newRows}\n    RETURNING {returning};"
+        self.seedNew = f"{newRows};" # bootstrap load, nothing to route
+        # %s: the highest eventid the cycle saw, per instance index (eventidCeilings); rows above
+        # it were pushed by webhook.py after the fetch and are left to the next cycle
+        self.deleteCleared = f"""DELETE FROM {table} a
+    WHERE NOT EXISTS (SELECT 1 FROM zabbix_open o WHERE o.eventid = a.eventid)
+    AND a.eventid <= COALESCE((%s::bigint[])[a.eventid / {InstanceIdOffset} + 1], a.eventid)
+    RETURNING {returning};"""
+        # Single events pushed by webhook.py
+        values = ["to_timestamp(%s)" if column == "clock" else "%s" for column in columns.split(", ")]
+        self.insertOne = f"""INSERT INTO {table} ({columns}) VALUES ({", ".join(values)})
+    ON CONFLICT (eventid) DO NOTHING
+    RETURNING {returning};"""
+        self.deleteOne = f"DELETE FROM {table} WHERE eventid = %s RETURNING {returning};"
+        # Cleared ids already known from the daemon's alert cache
+        self.deleteIds = f"DELETE FROM {table} WHERE eventid = ANY(%s) RETURNING {returning};"
+
+    # Single pass over the tags of each problem, only picking the two we need.
+    # AlertRow._make skips the Python-level namedtuple constructor.
+    def prepare(self, problems):
+        data = []
+        make = AlertRow._make
+        problemName, siteTag, hostTag = self.problemName, self.siteTag, self.hostTag
+        for element in problems:
+            if problemName and element["name"] != problemName:
+                continue
+            site = self.siteDefault
+            hostname = self.hostDefault
+            for tag in element.get("tags", ()):
+                key = tag["tag"]
+                if key == siteTag:
+                    site = tag["value"]
+                elif key == hostTag:
+                    hostname = tag["value"]
+            if hostname is None or (self.withSite and site is None):
+                continue
+            data.append(make((int(element["eventid"]), element["name"], int(element["clock"]), site, hostname)))
+        return data
+
+    # An AlertRow as parameters for insertOne (streams without a site column skip it)
+    def values(self, row):
+        if self.withSite:
+            return tuple(row)
+        return (row.eventid, row.name, row.clock, row.hostname)
+
+
+#########################################ROUTING##################################################
+# route(kind, AlertRow) -> (room id, message, label shown in digests); kind is "new" or "cleared"
+def routeHost(kind, row):
+    hostname = row.hostname
+    if kind == "new":
+        Message = hostAddMessage.format(hostname, row.name)
+    else:
+        Message = hostClearMessage.format(hostname)
+    return WebexRoomID, {"text": Message}, "VMware hosts"
+
+def routeSite(kind, row):
+    event_name = row.name
+    site = row.site
+    hostname = row.hostname
+
+    # Routing logic
+    if site == "UNKNOWN" or hostname == "UNKNOWN":
+        room_id = ADMINRoomID
+        if kind == "new":
+            Message = missingInfoMessage.format(site, hostname, event_name)
+            if ZabbixURL_ADMIN:
+                Message += f"\nMissing info Dashboard:({ZabbixURL_ADMIN})\n:q\n"
+        else:
+            Message = f"Site alert RESOLVED or Data fixed (check site room) Site: {site}, Host: {hostname}, Alert: {event_name}"
+            # --- Add ADMIN dashboard link if it exists ---
+            if ZabbixURL_ADMIN:
+                Message += f"\nMissing info Dashboard: ({ZabbixURL_ADMIN})\n\n"
+    else:
+        # If info is present, use the map. If not in map, use WebexRoomID (general)
+        room_id = siteRoomMap.get(site, WebexRoomID)
+        dashboard_url = siteDashboardMap.get(site)
+        if kind == "new":
+            Message = siteAddMessage.format(site, event_name, hostname)
+            # --- Add site dashboard link if it exists ---
+            if dashboard_url:
+                Message += f"\nSITE Dashboard:({dashboard_url})\n\n"
+        else:
+            Message = siteClearMessage.format(site, event_name, hostname)
+            if dashboard_url:
+                Message += f"\nSITE Dashboard: ({dashboard_url})\n\n"
+
+    if kind == "new":
+        return room_id, {"text": Message}, site
+    return room_id, {"markdown": Message}, site
+
+def routeCPOC(kind, row):
+    event_name = row.name
+    site = row.site
+    hostname = row.hostname
+    dashboard_url = ZabbixURL_CPOC
+    if kind == "new":
+        Message = cpocAddMessage.format(site, event_name, hostname)
+        if dashboard_url:
+            Message += f"\nCPOC Dashboard:({dashboard_url})\n\n"
+        return CPOCRoomID, {"text": Message}, site
+    Message = cpocClearMessage.format(site, event_name, hostname)
+    if dashboard_url:
+        Message += f"\nCPOC Dashboard: ({dashboard_url})\n\n"
+    return CPOCRoomID, {"markdown": Message}, site
+
+
+#########################################REGISTRY##################################################
+alertStreams = []
+
+def registerStream(stream):
+    alertStreams.append(stream)
+    return stream
+
+# VMware hypervisors down, any host group
+registerStream(AlertStream("host", "hostalerts", routeHost, problemName="VMware: Hypervisor is down",
+                           hostTag="hostname", withSite=False))
+# Site alerts (Group ID 557)
+registerStream(AlertStream("site", "sitealerts", routeSite, groupid=SiteGroupID,
+                           siteTag="site", siteDefault="UNKNOWN", hostTag="visname", hostDefault="UNKNOWN"))
+# CPOC alerts (Group ID 551)
+registerStream(AlertStream("cpoc", "cpocalerts", routeCPOC, groupid=CPOCGroupID,
+                           siteDefault="CPOC", hostTag="visname", hostDefault="UNKNOWN_HOST"))
+
+
+#########################################PARTITIONING##################################################
+# Distinct host groups the registered streams need an id-only membership query for
+def streamGroups():
+    groups = []
+    for stream in alertStreams:
+        if stream.groupid is not None and stream.groupid not in groups:
+            groups.append(stream.groupid)
+    return groups
+
+# Splitting the shared problem set into the registered streams: ungrouped streams take every problem,
+# grouped ones only the problems whose eventid is in their group's id set. openIds is given in
+# incremental mode only, where problems holds just the new ones; each stream then also gets its
+# complete open id set so that cleared alerts are still detected.
+# Returns {stream name: (problems, open ids as ints or None)}.
+def partitionProblems(problems, groupMembers, openIds=None):
+    cycleProblems = {}
+    for stream in alertStreams:
+        if stream.groupid is None:
+            streamProblems = problems
+            streamOpenIds = openIds
+        else:
+            members = groupMembers[stream.groupid]
+            streamProblems = [element for element in problems if element["eventid"] in members]
+            streamOpenIds = members
+        if openIds is not None:
+            streamOpenIds = {int(eventid) for eventid in streamOpenIds}
+        else:
+            streamOpenIds = None
+        cycleProblems[stream.name] = (streamProblems, streamOpenIds)
+    return cycleProblems
+
+# Tags the registered streams read, the ones hostmetadata.py fills in
+def streamTags():
+    tags = []
+    for stream in alertStreams:
+        for tag in (stream.siteTag, stream.hostTag):
+            if tag is not None and tag not in tags:
+                tags.append(tag)
+    return tags
+
+# Highest (eventid, clock) in a fetch, the next watermark
+def highestEvent(problems):
+    eventid = None
+    clock = None
+    for element in problems:
+        if eventid is None or int(element["eventid"]) > eventid:
+            eventid = int(element["eventid"])
+            clock = element["clock"]
+    return eventid, clock
@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+# Slow-cycle traces for newchecks.py (Trace_Slow_Cycle).
+# While a cycle runs it collects stage spans (scope, fetch, each stream's reconcile, delivery)
+# and every Zabbix, DB and Webex call with its duration and payload size. A cycle slower than
+# the threshold is written to Trace_Dir as cycle-<time>.json, plus a profile when Trace_Profile
+# is "sample" (stacks of every thread every Trace_Sample_Interval ms, folded for flame graphs)
+# or "cprofile" (the cycle's own thread, .pstats). Fast cycles are dropped. With the threshold
+# at 0 nothing is collected: every hook returns after one global check.
+import os
+import sys
+import json
+import time
+import cProfile
+import threading
+from collections import Counter
+from settings import TraceSlowCycle, TraceDir, TraceProfile, TraceSampleInterval
+
+# Spans and calls kept per trace; later ones are only counted
+maxCalls = 20000
+
+
+class CycleTrace:
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.wallStarted = time.time()
+        self.spans = []
+        self.calls = []
+        self.dropped = 0
+        self.lock = threading.Lock()
+
+    def offset(self):
+        return round(time.perf_counter() - self.started, 6)
+
+    def add(self, entries, entry):
+        with self.lock:
+            if len(self.calls) + len(self.spans) >= maxCalls:
+                self.dropped += 1
+            else:
+                entries.append(entry)
+
+class Span:
+    def __init__(self, trace, name, attrs):
+        self.trace = trace
+        self.name = name
+        self.attrs = attrs
+
+    def __enter__(self):
+        self.start = self.trace.offset()
+        return self
+
+    def __exit__(self, excType, exc, tb):
+        entry = {"stage": self.name, "start": self.start, "seconds": round(self.trace.offset() - self.start, 6),
+                 "thread": threading.current_thread().name}
+        entry.update(self.attrs)
+        if excType is not None:
+            entry["error"] = str(exc)
+        self.trace.add(self.trace.spans, entry)
+
+class NullSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return None
+
+nullSpan = NullSpan()
+
+
+# Stacks of every thread but its own, sampled until stopped
+class StackSampler(threading.Thread):
+    def __init__(self, interval):
+        super().__init__(name="trace-sampler", daemon=True)
+        self.interval = interval
+        self.stacks = Counter()
+        self.stopped = threading.Event()
+
+    def run(self):
+        names = {}
+        while not self.stopped.wait(self.interval):
+            for thread in threading.enumerate():
+                names[thread.ident] = thread.name
+            for ident, frame in sys._current_frames().items():
+                if ident == self.ident:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(f"{frame.f_code.co_name} ({os.path.basename(frame.f_code.co_filename)}:{frame.f_code.co_firstlineno})")
+                    frame = frame.f_back
+                stack.append(names.get(ident, str(ident)))
+                self.stacks[";".join(reversed(stack))] += 1
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+
+#########################################HOOKS##################################################
+# The running cycle's trace and profiler, None when tracing is off or between cycles
+active = None
+profiler = None
+
+def span(name, **attrs):
+    trace = active
+    if trace is None:
+        return nullSpan
+    return Span(trace, name, attrs)
+
+# A finished Zabbix/DB/Webex call
+def recordCall(kind, name, seconds, **attrs):
+    trace = active
+    if trace is None:
+        return
+    entry = {"kind": kind, "name": name, "end": trace.offset(), "seconds": round(seconds, 6),
+             "thread": threading.current_thread().name}
+    entry.update(attrs)
+    trace.add(trace.calls, entry)
+
+def startCycle():
+    global active, profiler
+    if not TraceSlowCycle:
+        return
+    active = CycleTrace()
+    if TraceProfile == "sample":
+        profiler = StackSampler(TraceSampleInterval / 1000)
+        profiler.start()
+    elif TraceProfile == "cprofile":
+        profiler = cProfile.Profile()
+        profiler.enable()
+
+# Returns the trace file written for a slow cycle, None otherwise
+def finishCycle():
+    global active, profiler
+    trace, cycleProfiler = active, profiler
+    active = None
+    profiler = None
+    if trace is None:
+        return None
+    if isinstance(cycleProfiler, StackSampler):
+        cycleProfiler.stop()
+    elif cycleProfiler is not None:
+        cycleProfiler.disable()
+
+    seconds = time.perf_counter() - trace.started
+    if seconds < TraceSlowCycle:
+        return None
+    try:
+        os.makedirs(TraceDir, exist_ok=True)
+        base = os.path.join(TraceDir, "cycle-" + time.strftime("%Y%m%d-%H%M%S", time.localtime(trace.wallStarted)))
+        with trace.lock:
+            document = {"started": trace.wallStarted, "seconds": round(seconds, 6), "threshold": TraceSlowCycle,
+                        "spans": trace.spans, "calls": trace.calls, "dropped": trace.dropped}
+        with open(base + ".json", "w") as traceFile:
+            json.dump(document, traceFile, indent=1)
+        if isinstance(cycleProfiler, StackSampler):
+            with open(base + ".folded", "w") as profileFile:
+                for stack, count in cycleProfiler.stacks.most_common():
+                    profileFile.write(f"{stack} {count}\n")
+        elif cycleProfiler is not None:
+            cycleProfiler.dump_stats(base + ".pstats")
+    except OSError as e:
+        print(f"Error writing slow cycle trace: {e}")
+        return None
+    return base + ".json"
@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+# Outbound Webex message dispatcher used by newchecks.py.
+# Messages are queued per room and drained by a bounded thread pool, so a slow
+# room or API call never holds up the DB transaction that produced the alert.
+import time
+import threading
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor, Future
+from webexteamssdk.exceptions import RateLimitError
+import metrics
+import tracing
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+# One-line delivery report, also used by the asyncio sender in asyncengine.py
+def deliverySummary(sent, failed, rateLimited, latencies, queueDelays):
+    return (f"Webex: {sent} sent, {failed} failed, {rateLimited} rate limited, "
+            f"latency p50 {percentile(latencies, 0.5) * 1000:.0f} ms p95 {percentile(latencies, 0.95) * 1000:.0f} ms "
+            f"max {percentile(latencies, 1) * 1000:.0f} ms, queue-to-delivery p95 {percentile(queueDelays, 0.95) * 1000:.0f} ms")
+
+
+class WebexDispatcher:
+    def __init__(self, api, maxWorkers=8, roomConcurrency=1, maxRetries=3):
+        # api is a WebexTeamsAPI created with wait_on_rate_limit=False, 429s are handled here
+        self.api = api
+        self.roomConcurrency = roomConcurrency # 1 keeps messages ordered inside a room
+        self.maxRetries = maxRetries
+        self.executor = ThreadPoolExecutor(max_workers=maxWorkers, thread_name_prefix="webex")
+
+        self.lock = threading.Lock()
+        self.idle = threading.Condition(self.lock)
+        self.queues = defaultdict(deque)
+        self.activeRooms = defaultdict(int)
+        self.pending = 0
+        self.pausedUntil = 0.0 # Webex rate limits per token, so a 429 pauses every worker
+
+        self.resetStats()
+
+    def resetStats(self):
+        self.sent = 0
+        self.failed = 0
+        self.rateLimited = 0
+        self.latencies = [] # seconds per successful messages.create call
+        self.queueDelays = [] # seconds from send() to delivery
+
+    # Queue a message; returns immediately with a Future that resolves to True once delivered
+    def send(self, roomId, **message):
+        result = Future()
+        with self.lock:
+            self.queues[roomId].append((time.monotonic(), message, result))
+            self.pending += 1
+            if self.activeRooms[roomId] < self.roomConcurrency:
+                self.activeRooms[roomId] += 1
+                try:
+                    self.executor.submit(self.drainRoom, roomId)
+                except RuntimeError:
+                    # Shut down: nothing will drain the message, so flush() must not wait for it
+                    self.queues[roomId].pop()
+                    self.activeRooms[roomId] -= 1
+                    self.pending -= 1
+                    if self.pending == 0:
+                        self.idle.notify_all()
+                    raise
+        return result
+
+    def drainRoom(self, roomId):
+        while True:
+            with self.lock:
+                if not self.queues[roomId]:
+                    self.activeRooms[roomId] -= 1
+                    return
+                queuedAt, message, result = self.queues[roomId].popleft()
+            delivered = False
+            try:
+                delivered = self.deliver(roomId, queuedAt, message)
+            finally:
+                result.set_result(delivered)
+                with self.lock:
+                    self.pending -= 1
+                    if self.pending == 0:
+                        self.idle.notify_all()
+
+    def waitForRateLimit(self):
+        while True:
+            with self.lock:
+                delay = self.pausedUntil - time.monotonic()
+            if delay <= 0:
+                return
+            time.sleep(delay)
+
+    def deliver(self, roomId, queuedAt, message):
+        for attempt in range(self.maxRetries + 1):
+            self.waitForRateLimit()
+            started = time.monotonic()
+            try:
+                self.api.messages.create(roomId=roomId, **message)
+            except RateLimitError as e:
+                metrics.webexMessages.inc(result="rate_limited")
+                retryAfter = e.retry_after or 1
+                with self.lock:
+                    self.rateLimited += 1
+                    self.pausedUntil = max(self.pausedUntil, time.monotonic() + retryAfter)
+                continue
+            except Exception as e:
+                print(f"Error sending Webex message to room {roomId}: {e}")
+                break
+            finished = time.monotonic()
+            metrics.webexSendSeconds.observe(finished - started)
+            tracing.recordCall("webex", "messages.create", finished - started, room=roomId,
+                               bytes=sum(len(str(value)) for value in message.values()))
+            metrics.webexMessages.inc(result="sent")
+            with self.lock:
+                self.sent += 1
+                self.latencies.append(finished - started)
+                self.queueDelays.append(finished - queuedAt)
+            return True
+
+        metrics.webexMessages.inc(result="failed")
+        with self.lock:
+            self.failed += 1
+        return False
+
+    # Block until every queued message was delivered or given up on
+    def flush(self, timeout=None):
+        with self.lock:
+            return self.idle.wait_for(lambda: self.pending == 0, timeout)
+
+    def summary(self):
+        with self.lock:
+            return deliverySummary(self.sent, self.failed, self.rateLimited, self.latencies, self.queueDelays)
+
+    def shutdown(self, timeout=None):
+        self.flush(timeout)
+        self.executor.shutdown(wait=False)
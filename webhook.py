@@ -0,0 +1,224 @@
+#!/usr/bin/env python3
+# Push ingestion for Zabbix webhook media types (newchecks.py --daemon --webhook).
+# Zabbix POSTs every problem and recovery event here as JSON. A problem goes through the
+# same stream tag extraction and routing as a polled one and its notification is queued
+# in the outbox in the same transaction as the alert row; the delivery worker is woken
+# right after the commit instead of at its next poll. The daemon keeps reconciling at a
+# long --interval as the safety net for events the webhook missed.
+#
+# Webhook parameters (the media type script POSTs them as one JSON object):
+#   eventid   {EVENT.ID}          the problem event, also on recovery
+#   value     {EVENT.VALUE}       1 problem, 0 recovery
+#   name      {EVENT.NAME}
+#   clock     {EVENT.TIMESTAMP}   optional, receive time otherwise
+#   severity  {EVENT.NSEVERITY}   optional, below 5 is ignored like in the polled fetch
+#   tags      {EVENT.TAGSJSON}
+#   instance  the sending server's Zabbix_Instances name, optional for the first one
+# Host groups are not in the payload, so a problem costs one id-only problem.get per stream group.
+import hmac
+import json
+import time
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import psycopg2 as p
+from zabbix_utils import ZabbixAPI
+from settings import (ZabbixInstances, WebhookHost, WebhookPort, WebhookToken, WebhookMaxBody, WebhookPoolSize,
+                      FlapThreshold, FlapWindow, FlapHoldDown)
+from queries import eventIdParams, clearedInsert
+from streams import AlertRow, alertStreams, streamGroups
+from outbox import queueNotifications
+from sharding import lockStream
+from alertcache import bumpVersion
+from flapping import filterFlapping
+from database import DatabasePool, execute
+import metrics
+from zabbixinstances import buildInstances
+
+
+# Payload -> (kind, instance, problem with the instance-qualified eventid); ValueError if unusable
+def parseEvent(payload, instances):
+    if not isinstance(payload, dict) or "eventid" not in payload:
+        raise ValueError("no eventid")
+    instanceName = payload.get("instance") or instances[0].name
+    instance = next((instance for instance in instances if instance.name == instanceName), None)
+    if instance is None:
+        raise ValueError(f"unknown instance {instanceName}")
+
+    tags = payload.get("tags") or []
+    if isinstance(tags, str):
+        tags = json.loads(tags) if tags.strip() else []
+    problem = {
+        "eventid": instance.qualify(payload["eventid"]),
+        "name": payload.get("name", ""),
+        "clock": str(int(payload.get("clock") or time.time())),
+        "tags": tags
+    }
+    kind = "cleared" if str(payload.get("value", "1")) == "0" else "new"
+    return kind, instance, problem
+
+# Stream host groups the instance's problem belongs to (instance eventid, not qualified)
+def eventGroups(instance, eventid):
+    groups = set()
+    for groupid in streamGroups():
+        request = eventIdParams(instance.groupid(groupid))
+        request["eventids"] = [str(eventid)]
+        if instance.api.problem.get(request):
+            groups.add(groupid)
+    return groups
+
+# One event in one transaction: the alert rows of every stream it belongs to plus their
+# outbox notifications (minus flapping ones) and alertversions bump. Each stream's lock
+# makes it wait for a reconcile of that stream to commit. A recovery is also recorded in
+# alertcleared, so a reconcile that fetched the problem while it was open does not re-add it.
+# Returns the number of notifications queued.
+def applyEvent(dbconn, kind, problem, groups=()):
+    cur = dbconn.cursor()
+    try:
+        outgoing = []
+        recorded = []
+        for stream in alertStreams:
+            if kind == "new":
+                if stream.groupid is not None and stream.groupid not in groups:
+                    continue
+                rows = stream.prepare([problem])
+                if not rows:
+                    continue
+                lockStream(cur, stream.name, wait=True)
+                execute(cur, f"webhook_new_{stream.name}", stream.insertOne, stream.values(rows[0]))
+            else:
+                lockStream(cur, stream.name, wait=True)
+                execute(cur, "webhook_cleared_record", clearedInsert, (stream.name, stream.name, int(problem["eventid"])))
+                execute(cur, f"webhook_cleared_{stream.name}", stream.deleteOne, (int(problem["eventid"]),))
+            changes = [(kind, row) for row in map(AlertRow._make, cur.fetchall())]
+            if changes:
+                streamOutgoing = filterFlapping(cur, stream, changes, FlapThreshold, FlapWindow, FlapHoldDown)
+                bumpVersion(cur, stream.name)
+                outgoing += streamOutgoing
+                recorded.append((stream.name, changes, streamOutgoing))
+        queueNotifications(cur, outgoing)
+        dbconn.commit()
+        for streamName, changes, streamOutgoing in recorded:
+            metrics.recordChanges(streamName, changes, streamOutgoing)
+        return len(outgoing)
+    except p.Error:
+        dbconn.rollback()
+        raise
+    finally:
+        cur.close()
+
+
+#########################################SERVER##################################################
+# Errors answer 503 so the media type retries; the periodic reconcile catches whatever is left
+class WebhookHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        receiver = self.server.receiver
+        if WebhookToken:
+            supplied = self.headers.get("Authorization", "").removeprefix("Bearer ").strip()
+            if not hmac.compare_digest(supplied, WebhookToken):
+                return self.reply(401, {"error": "unauthorized"})
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+        except ValueError:
+            return self.reply(400, {"error": "bad Content-Length"})
+        if length < 0 or length > WebhookMaxBody:
+            # The body is not read, so the connection cannot be reused
+            self.close_connection = True
+            return self.reply(413, {"error": f"event over {WebhookMaxBody} bytes"})
+        try:
+            payload = json.loads(self.rfile.read(length))
+            if int(payload.get("severity", 5)) < 5:
+                return self.reply(200, {"queued": 0})
+            kind, instance, problem = parseEvent(payload, receiver.instances)
+        except (ValueError, TypeError, AttributeError) as e:
+            return self.reply(400, {"error": f"bad event: {e}"})
+
+        try:
+            queued = receiver.ingest(kind, instance, problem, payload["eventid"])
+        except Exception as e:
+            print(f"Error ingesting webhook event {problem['eventid']}: {e}")
+            return self.reply(503, {"error": "not stored, retry"})
+        self.reply(200, {"queued": queued})
+
+    def reply(self, status, body):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    # Every request would otherwise be logged to stderr
+    def log_message(self, format, *args):
+        pass
+
+
+# Without Webhook_Token anyone who can reach the port could queue Webex messages,
+# so unauthenticated events are only taken on a loopback address
+loopbackHosts = ("127.0.0.1", "::1", "localhost")
+
+def checkExposure(host, token):
+    if not token and host not in loopbackHosts:
+        raise ValueError(f"Webhook_Token is not set, refusing to listen on {host} (set it, or Webhook_Host=127.0.0.1)")
+
+
+# The HTTP server with its own Zabbix sessions and DB pool, so a reconnecting daemon cycle
+# does not pull them from under a request. onQueued is called after a commit that queued messages.
+class WebhookReceiver:
+    def __init__(self, onQueued=None, host=WebhookHost, port=WebhookPort):
+        checkExposure(host, WebhookToken)
+        self.onQueued = onQueued
+        self.instances = buildInstances(ZabbixInstances)
+        for instance in self.instances:
+            instance.api = ZabbixAPI(url=instance.url)
+            instance.api.login(token=instance.token)
+        self.pool = DatabasePool(WebhookPoolSize)
+        self.server = ThreadingHTTPServer((host, port), WebhookHandler)
+        self.server.daemon_threads = True
+        self.server.receiver = self
+        self.thread = None
+        self.stats = {"events": 0, "queued": 0, "errors": 0}
+        self.statsLock = threading.Lock()
+
+    def ingest(self, kind, instance, problem, instanceEventid):
+        try:
+            groups = eventGroups(instance, instanceEventid) if kind == "new" else ()
+            dbconn = self.pool.getconn()
+            try:
+                queued = applyEvent(dbconn, kind, problem, groups)
+            finally:
+                self.pool.putconn(dbconn)
+        except Exception:
+            with self.statsLock:
+                self.stats["errors"] += 1
+            raise
+        with self.statsLock:
+            self.stats["events"] += 1
+            self.stats["queued"] += queued
+        if queued and self.onQueued is not None:
+            self.onQueued()
+        return queued
+
+    # Counts since the last call, for the daemon's cycle log
+    def summary(self):
+        with self.statsLock:
+            stats = dict(self.stats)
+            for key in self.stats:
+                self.stats[key] = 0
+        return f"Webhook: {stats['events']} events, {stats['queued']} messages queued, {stats['errors']} errors"
+
+    def start(self):
+        if not WebhookToken:
+            print("Webhook_Token is not set, the webhook endpoint accepts unauthenticated events from this host")
+        self.thread = threading.Thread(target=self.server.serve_forever, name="webhook", daemon=True)
+        self.thread.start()
+        print(f"Listening for Zabbix webhook events on {self.server.server_address[0]}:{self.server.server_address[1]}")
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+        for instance in self.instances:
+            try:
+                instance.api.logout()
+            except Exception:
+                pass
+        self.pool.closeall()
@@ -0,0 +1,52 @@
+#!/usr/bin/env python3
+# Zabbix servers polled by newchecks.py, asyncengine.py and zabbixpersite.py.
+# Every instance has its own session and token. Eventids are only unique per instance,
+# so they are qualified before they reach the streams: instance N adds N * InstanceIdOffset,
+# which leaves the first instance's eventids (and every row stored before) unchanged.
+InstanceIdOffset = 10 ** 15
+
+
+class ZabbixInstance:
+    def __init__(self, name, index, url, token, groupMap=None):
+        self.name = name
+        self.index = index
+        self.url = url
+        self.token = token
+        self.groupMap = groupMap or {}
+        self.offset = index * InstanceIdOffset
+        self.api = None # ZabbixAPI or AsyncZabbixAPI, logged in by the engine
+        self.metadata = None # HostMetadata, when the engine fills tags from the hosts
+
+    # Stream host group ids are the first instance's; others map them to their own
+    def groupid(self, groupid):
+        return self.groupMap.get(groupid, groupid)
+
+    def qualify(self, eventid):
+        return str(self.offset + int(eventid))
+
+    # In place, so a page is never copied
+    def qualifyProblems(self, problems):
+        if self.offset:
+            for element in problems:
+                element["eventid"] = self.qualify(element["eventid"])
+        return problems
+
+    def qualifyIds(self, problems):
+        return {self.qualify(element["eventid"]) for element in problems}
+
+    # Watermarks hold the instance's own eventids, one row per stream and instance
+    def watermarkKey(self, streamName):
+        if self.index == 0:
+            return streamName
+        return f"{streamName}@{self.name}"
+
+
+def buildInstances(instanceSettings):
+    return [ZabbixInstance(config["name"], index, config["url"], config["token"], config["groupMap"])
+            for index, config in enumerate(instanceSettings)]
+
+# The streams' deleteCleared parameter, by instance index: the highest own eventid a cycle saw on
+# each instance, qualified. None (nothing seen) leaves that instance's rows uncapped.
+def eventidCeilings(instances, highest):
+    return [None if highest.get(instance.name) is None else instance.offset + highest[instance.name]
+            for instance in instances]